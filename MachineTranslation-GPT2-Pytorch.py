@@ -13,12 +13,11 @@ import warnings
 warnings.filterwarnings('ignore')
 
 import torch
-from torch.utils.data import DataLoader, TensorDataset
-from transformers import GPT2LMHeadModel, GPT2Tokenizer
+from soft_prompt import CompiledSoftPrompt, GPT2WithSoftPrompt, load_soft_prompt, quantize_backbone, save_soft_prompt, set_inductor_cache_dir
+from data_utils import ParallelCorpus, batch_encode, cached_tokenize, get_tokenizer, make_dataloader
+from metrics import MetricAccumulator, MetricWorkerPool, compare_models
 import pandas as pd
 from datasets import load_dataset
-import nltk
-from nltk.translate.bleu_score import corpus_bleu
 
 
 # Constants
@@ -27,6 +26,21 @@ BATCH_SIZE = 1
 EPOCHS = 1
 PROMPT_TOKEN = "[TRANSLATE]"
 MAX_LEN = 500
+PRECISION = "fp32"  # "bf16" runs the frozen GPT-2 under bfloat16 autocast, e.g. on AVX512-BF16/AMX CPUs
+GRADIENT_CHECKPOINTING = False  # recompute the GPT-2 blocks in backward: far less activation memory for about one extra forward
+COMPILED_INFERENCE = False  # run the Inference cells through exported + torch.compile graphs, one per shape bucket
+COMPILED_CACHE_DIR = "compiled_cache"  # exported graphs and compiled kernels, reused by later runs
+TOKENIZER_WORKERS = 0  # > 1 spreads tokenization over a process pool
+TOKEN_CACHE_DIR = "token_cache"  # None disables the on-disk token cache
+DATALOADER_WORKERS = 2  # Processes collating batches ahead of the model, 0 collates in the main process
+PIN_MEMORY = torch.cuda.is_available()  # Page-locked batches for asynchronous copies to the GPU
+METRICS_LOG_INTERVAL = 0  # Training steps between metric read-backs, 0 reads them once per epoch
+METRIC_WORKERS = 2  # Processes decoding and scoring BLEU off the model loop, 0 scores inline
+NUM_SENTENCE_PAIRS = 600
+SAMPLE_PAIRS = False  # A seeded random sample of NUM_SENTENCE_PAIRS instead of the first ones
+DATA_SEED = 0
+TRAIN_BLEU_EVERY = 10  # BLEU on every Nth training batch, 0 turns it off during training
+BLEU_ON_TOKEN_IDS = False  # Score GPT-2 token ids instead of decoded words: faster, but not comparable to word-level BLEU
 
 # Soft Prompt Vocabulary
 soft_prompt_vocab = ["[TRANSLATE]"]  # Define your custom vocabulary here
@@ -37,56 +51,33 @@ soft_prompt_word2idx = {word: idx for idx, word in enumerate(soft_prompt_vocab)}
 num_prompts = len([soft_prompt_word2idx[word] for word in PROMPT_TOKEN.split()])
 prompt_id = torch.tensor([soft_prompt_word2idx[word] for word in PROMPT_TOKEN.split()])
 
-# Model Architecture
-class GPT2WithSoftPrompt(torch.nn.Module):
-    def __init__(self, model_name, num_prompts, embedding_size=768):
-        super().__init__()
-        self.gpt2 = GPT2LMHeadModel.from_pretrained(model_name)
-        self.soft_prompt = torch.nn.Embedding(num_prompts, embedding_size)
-
-    def forward(self, input_ids, prompt_ids):
-        prompt_embeddings = self.soft_prompt(prompt_ids)
-        base_embeddings = self.gpt2.transformer.wte(input_ids)
-        embeddings = torch.cat([prompt_embeddings, base_embeddings.squeeze(0)], dim=0)
-        outputs = self.gpt2(inputs_embeds=embeddings)
-        return outputs
-
 
 def load_data_from_files(english_file, german_file):
-    with open(english_file, "r", encoding="utf-8") as eng_file:
-        english_list = eng_file.readlines()
-
-    with open(german_file, "r", encoding="utf-8") as ger_file:
-        german_list = ger_file.readlines()
-
-    return english_list[:600], german_list[:600]
+    # Seeks to the wanted lines through a byte-offset index of both files (built once and kept
+    # in TOKEN_CACHE_DIR) instead of reading the whole corpus
+    corpus = ParallelCorpus(english_file, german_file, cache_dir=TOKEN_CACHE_DIR)
+    if SAMPLE_PAIRS:
+        return corpus.sample(NUM_SENTENCE_PAIRS, seed=DATA_SEED)
+    return corpus.read(0, NUM_SENTENCE_PAIRS)
 
 
 # Data Loading and Preprocessing
 def load_and_preprocess_data(english_file, german_file, num_prompts):
-    english_list, german_list = load_data_from_files(english_file, german_file)
-
-    # Perform preprocessing on the data
-    tokenized_english = []
-    tokenized_german = []
+    def tokenize():
+        english_list, german_list = load_data_from_files(english_file, german_file)
 
-    tokenizer = GPT2Tokenizer.from_pretrained(MODEL_NAME)
+        # Perform preprocessing on the data, a whole list per call on the fast tokenizer.
+        # Padding is added per batch by SoftPromptCollator.
+        tokenized_english = batch_encode(english_list, MODEL_NAME, max_length=MAX_LEN, num_workers=TOKENIZER_WORKERS)
+        tokenized_german = batch_encode(german_list, MODEL_NAME, max_length=MAX_LEN, num_workers=TOKENIZER_WORKERS)
+        return tokenized_english, tokenized_german
 
-    for english_sentence, german_sentence in zip(english_list, german_list):
-        english_tokens = tokenizer.encode(english_sentence, truncation=True, max_length=MAX_LEN)
-        german_tokens = tokenizer.encode(german_sentence, truncation=True, max_length=MAX_LEN)
-
-        # Pad the sequences to MAX_LEN
-        padded_english = english_tokens + [tokenizer.eos_token_id] * (MAX_LEN-1 - len(english_tokens))
-        padded_german = german_tokens + [tokenizer.eos_token_id] * (MAX_LEN - len(german_tokens))
-
-        tokenized_english.append(padded_english)
-        tokenized_german.append(padded_german)
-
-    return tokenized_english, tokenized_german
+    # Repeat runs read the memory-mapped token cache instead of the corpus
+    settings = {"max_length": MAX_LEN, "num_sentence_pairs": NUM_SENTENCE_PAIRS, "sample_seed": DATA_SEED if SAMPLE_PAIRS else None}
+    return cached_tokenize(TOKEN_CACHE_DIR, "europarl", [english_file, german_file], MODEL_NAME, settings, tokenize)
 
 # Load and preprocess the data
-tokenizer = GPT2Tokenizer.from_pretrained(MODEL_NAME)
+tokenizer = get_tokenizer(MODEL_NAME)
 
 tokenized_articles_total , tokenized_summaries_total = load_and_preprocess_data("europarl-v7.de-en.en", "europarl-v7.de-en.de",num_prompts)
 total_samples = len(tokenized_articles_total)
@@ -111,7 +102,7 @@ device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
 
 # # Model Initialization
-model = GPT2WithSoftPrompt(MODEL_NAME, num_prompts).to(device)
+model = GPT2WithSoftPrompt(MODEL_NAME, num_prompts, precision=PRECISION, gradient_checkpointing=GRADIENT_CHECKPOINTING).to(device)
 
 from tqdm import tqdm
 
@@ -123,7 +114,6 @@ GRADIENT_CLIP_NORM = 1.0
 EARLY_STOPPING_PATIENCE = 2
 prompt_id = prompt_id.to(device)
 # Import cross_entropy_loss
-from torch.nn import CrossEntropyLoss
 
 def fine_tune_on_summarization(model, train_articles, train_summaries, val_articles, val_summaries, test_articles, test_summaries):
     optimizer = torch.optim.Adam(model.soft_prompt.parameters())
@@ -131,106 +121,91 @@ def fine_tune_on_summarization(model, train_articles, train_summaries, val_artic
     best_val_loss = float('inf')
     no_improvement_epochs = 0
 
+    # Built once: the persistent workers are reused by every epoch
+    train_loader = make_dataloader(train_articles, train_summaries, BATCH_SIZE, tokenizer.eos_token_id, num_prompts, shuffle=True, num_workers=DATALOADER_WORKERS, pin_memory=PIN_MEMORY)
+    val_loader = make_dataloader(val_articles, val_summaries, BATCH_SIZE, tokenizer.eos_token_id, num_prompts, num_workers=DATALOADER_WORKERS, pin_memory=PIN_MEMORY)
+    # Decoded-text metrics run in background processes and are merged at the end of each epoch
+    text_metrics = MetricWorkerPool("bleu", MODEL_NAME, ignore_ids=[tokenizer.eos_token_id], num_workers=METRIC_WORKERS, decode=not BLEU_ON_TOKEN_IDS)
+
     for epoch in range(EPOCHS):
         model.train()
 
         # Gradient accumulation initialization
         optimizer.zero_grad()
-        accumulated_loss = 0
-        loss = 0
+        window_tokens = 0
         # Use tqdm for progress bar
-        with tqdm(enumerate(zip(train_articles, train_summaries)), total=len(train_articles), desc=f"Epoch {epoch + 1}/{EPOCHS}", unit="batch") as progress:
-            train_percentage_matched = 0
-            train_percentage_matched_ct = 0
-            train_pred_sentences = []
-            train_true_sentences = []
-            for idx, (article, summary) in progress:
-                input_ids = torch.tensor(article).to(device)
-                labels = torch.tensor(summary).to(device)
-                outputs = model(input_ids, prompt_id)
-
-                # Bleu Score
-                pred_logits = outputs.logits
-                predicted_token_ids = torch.argmax(pred_logits, dim=-1)
-                predicted_tokens = tokenizer.decode(predicted_token_ids, skip_special_tokens=True)
-                train_pred_sentences.append(predicted_tokens.split())
-                predicted_tokens = tokenizer.decode(labels, skip_special_tokens=True)
-                train_true_sentences.append(predicted_tokens.split())
-
-
+        train_loader.batch_sampler.set_epoch(epoch)
+        with tqdm(enumerate(train_loader), total=len(train_loader), desc=f"Epoch {epoch + 1}/{EPOCHS}", unit="batch") as progress:
+            train_metrics = MetricAccumulator(device)
+            for idx, (input_ids, attention_mask, labels) in progress:
+                input_ids = input_ids.to(device, non_blocking=True)
+                attention_mask = attention_mask.to(device, non_blocking=True)
+                labels = labels.to(device, non_blocking=True)
+                # Hidden states only: the LM head is applied in chunks by lm_loss/lm_argmax, never to all positions at once
+                hidden_states = model.hidden_states(input_ids, prompt_id, attention_mask=attention_mask)
                 ignore_index = tokenizer.eos_token_id
-                loss += CrossEntropyLoss(ignore_index=ignore_index)(outputs.logits, labels)
-
-                # Metrics
-                set1 = set(torch.argmax(outputs.logits, dim=1).cpu().numpy())
-                set2 = set(labels.cpu().numpy())
-
-                # Calculate the intersection of sets
-                intersection = set1.intersection(set2)
-
-                # Calculate the percentage of indices in the first tensor that are also in the second tensor
-                percentage = (len(intersection) / len(set1)) * 100
-                train_percentage_matched += percentage
-                train_percentage_matched_ct += 1
-
-                # Backpropagate losses every GRADIENT_ACCUMULATION_STEPS or at the end of the dataset
-                if (idx + 1) % GRADIENT_ACCUMULATION_STEPS == 0 or idx == len(train_articles) - 1:
-                    (loss / GRADIENT_ACCUMULATION_STEPS).backward()
-                    torch.nn.utils.clip_grad_norm_(model.parameters(), GRADIENT_CLIP_NORM)
+                predictions = model.lm_argmax(hidden_states, positions=labels != ignore_index, fill_value=ignore_index)
+
+                # Bleu Score, scored off-thread for every TRAIN_BLEU_EVERY-th batch
+                if TRAIN_BLEU_EVERY and idx % TRAIN_BLEU_EVERY == 0:
+                    text_metrics.submit(predictions, labels)
+
+                # Each micro-step backpropagates its summed token loss right away, so its graph is freed
+                # before the next one; the gradients are divided by the window's real label count below
+                step_loss_sum = model.lm_loss(hidden_states, labels, ignore_index=ignore_index, reduction="sum")
+                step_loss_sum.backward()
+                step_tokens = (labels != ignore_index).sum()
+                window_tokens += step_tokens
+                step_loss = step_loss_sum.detach() / step_tokens
+
+                # Metrics, accumulated on the device
+                train_metrics.update(predictions, labels, step_loss, ignore_index=ignore_index)
+                if METRICS_LOG_INTERVAL and (idx + 1) % METRICS_LOG_INTERVAL == 0:
+                    progress.set_postfix(train_metrics.compute())
+
+                # Update every GRADIENT_ACCUMULATION_STEPS or at the end of the dataset, with the mean
+                # loss gradient over every real label token of the window
+                if (idx + 1) % GRADIENT_ACCUMULATION_STEPS == 0 or idx == len(train_loader) - 1:
+                    for param in model.soft_prompt.parameters():
+                        param.grad.div_(window_tokens.clamp(min=1))
+                    torch.nn.utils.clip_grad_norm_(model.soft_prompt.parameters(), GRADIENT_CLIP_NORM)
                     optimizer.step()
                     optimizer.zero_grad()
-                    loss = 0
+                    window_tokens = 0
 
-            print("Train : % Exact Match: ",train_percentage_matched/train_percentage_matched_ct)
-            try:
-                bleu_score = corpus_bleu(train_true_sentences, train_pred_sentences)
-                print(f'Train BLEU Score: {bleu_score}')
-            except:
-                pass
+            train_results = train_metrics.compute()
+            print("Train : % Exact Match: ", train_results["overlap"])
+            if TRAIN_BLEU_EVERY:
+                print(f'Train BLEU Score: {text_metrics.compute()}')
 
 
         # Validation
         model.eval()
-        total_val_loss = 0
-        val_pred_sentences = []
-        val_true_sentences = []
         with torch.no_grad():
-            val_percentage_matched = 0
-            val_percentage_matched_ct = 0
-            for article, summary in tqdm(zip(val_articles, val_summaries), total=len(val_articles), desc="Validation", unit="batch"):
-                input_ids = torch.tensor(article).to(device)
-                labels = torch.tensor(summary).to(device)
-                outputs = model(input_ids, prompt_id)
-
-                # Bleu Score
-                pred_logits = outputs.logits
-                predicted_token_ids = torch.argmax(pred_logits, dim=-1)
-                predicted_tokens = tokenizer.decode(predicted_token_ids, skip_special_tokens=True)
-                val_pred_sentences.append(predicted_tokens.split())
-                predicted_tokens = tokenizer.decode(labels, skip_special_tokens=True)
-                val_true_sentences.append(predicted_tokens.split())
-
+            val_metrics = MetricAccumulator(device)
+            for input_ids, attention_mask, labels in tqdm(val_loader, total=len(val_loader), desc="Validation", unit="batch"):
+                input_ids = input_ids.to(device, non_blocking=True)
+                attention_mask = attention_mask.to(device, non_blocking=True)
+                labels = labels.to(device, non_blocking=True)
+                hidden_states = model.hidden_states(input_ids, prompt_id, attention_mask=attention_mask)
                 ignore_index = tokenizer.eos_token_id if tokenizer.eos_token_id is not None else -100
-                val_loss = CrossEntropyLoss(ignore_index=ignore_index)(outputs.logits, labels)
-                total_val_loss += val_loss.item()
+                # Only the positions with a real label go through the LM head
+                predictions = model.lm_argmax(hidden_states, positions=labels != ignore_index, fill_value=ignore_index)
 
-                # Metrics
-                set1 = set(torch.argmax(outputs.logits, dim=1).cpu().numpy())
-                set2 = set(labels.cpu().numpy())
+                # Bleu Score, scored off-thread
+                text_metrics.submit(predictions, labels)
 
-                # Calculate the intersection of sets
-                intersection = set1.intersection(set2)
+                val_loss = model.lm_loss(hidden_states, labels, ignore_index=ignore_index)
 
-                # Calculate the percentage of indices in the first tensor that are also in the second tensor
-                percentage = (len(intersection) / len(set1)) * 100
-                val_percentage_matched += percentage
-                val_percentage_matched_ct += 1
+                # Metrics, accumulated on the device
+                val_metrics.update(predictions, labels, val_loss, ignore_index=ignore_index)
 
 
-        print("Val : % Exact Match: ",val_percentage_matched/val_percentage_matched_ct)
-        avg_val_loss = total_val_loss / len(val_articles)
+        val_results = val_metrics.compute()
+        print("Val : % Exact Match: ", val_results["overlap"])
+        avg_val_loss = val_results["loss"]
         print("Val Loss : ",avg_val_loss)
-        bleu_score = corpus_bleu(val_true_sentences, val_pred_sentences)
+        bleu_score = text_metrics.compute()
         print(f'Val BLEU Score: {bleu_score}')
 
         # Early stopping
@@ -245,74 +220,75 @@ def fine_tune_on_summarization(model, train_articles, train_summaries, val_artic
 
     # Testing
     model.eval()
-    test_pred_sentences = []
-    test_true_sentences = []
-    total_test_loss = 0
     with torch.no_grad():
-        test_percentage_matched = 0
-        test_percentage_matched_ct = 0
-        for article, summary in tqdm(zip(test_articles, test_summaries), total=len(test_articles), desc="Validation", unit="batch"):
-            input_ids = torch.tensor(article).to(device)
-            labels = torch.tensor(summary).to(device)
-            outputs = model(input_ids, prompt_id)
-
-            # Bleu Score
-            pred_logits = outputs.logits
-            predicted_token_ids = torch.argmax(pred_logits, dim=-1)
-            predicted_tokens = tokenizer.decode(predicted_token_ids, skip_special_tokens=True)
-            test_pred_sentences.append(predicted_tokens.split())
-            predicted_tokens = tokenizer.decode(labels, skip_special_tokens=True)
-            test_true_sentences.append(predicted_tokens.split())
-
+        test_metrics = MetricAccumulator(device)
+        test_loader = make_dataloader(test_articles, test_summaries, BATCH_SIZE, tokenizer.eos_token_id, num_prompts, num_workers=DATALOADER_WORKERS, pin_memory=PIN_MEMORY)
+        for input_ids, attention_mask, labels in tqdm(test_loader, total=len(test_loader), desc="Validation", unit="batch"):
+            input_ids = input_ids.to(device, non_blocking=True)
+            attention_mask = attention_mask.to(device, non_blocking=True)
+            labels = labels.to(device, non_blocking=True)
+            hidden_states = model.hidden_states(input_ids, prompt_id, attention_mask=attention_mask)
             ignore_index = tokenizer.eos_token_id if tokenizer.eos_token_id is not None else -100
-            test_loss = CrossEntropyLoss(ignore_index=ignore_index)(outputs.logits, labels)
-            total_test_loss += test_loss.item()
+            # Only the positions with a real label go through the LM head
+            predictions = model.lm_argmax(hidden_states, positions=labels != ignore_index, fill_value=ignore_index)
 
-            # Metrics
-            set1 = set(torch.argmax(outputs.logits, dim=1).cpu().numpy())
-            set2 = set(labels.cpu().numpy())
+            # Bleu Score, scored off-thread
+            text_metrics.submit(predictions, labels)
 
-            # Calculate the intersection of sets
-            intersection = set1.intersection(set2)
+            test_loss = model.lm_loss(hidden_states, labels, ignore_index=ignore_index)
 
-            # Calculate the percentage of indices in the first tensor that are also in the second tensor
-            percentage = (len(intersection) / len(set1)) * 100
-            test_percentage_matched += percentage
-            test_percentage_matched_ct += 1
+            # Metrics, accumulated on the device
+            test_metrics.update(predictions, labels, test_loss, ignore_index=ignore_index)
 
 
-        print("Test : % Exact Match: ",test_percentage_matched/test_percentage_matched_ct)
-        avg_test_loss = total_test_loss / len(test_articles)
+        test_results = test_metrics.compute()
+        print("Test : % Exact Match: ", test_results["overlap"])
+        avg_test_loss = test_results["loss"]
         print("Test Loss : ",avg_test_loss)
-        bleu_score = corpus_bleu(test_true_sentences, test_pred_sentences)
+        bleu_score = text_metrics.compute()
         print(f'Test BLEU Score: {bleu_score}')
 
 
+    text_metrics.close()
     return model
 
 fine_tuned_model = fine_tune_on_summarization(model, tokenized_articles_train, tokenized_summaries_train, tokenized_articles_validation, tokenized_summaries_validation, tokenized_articles_test, tokenized_summaries_test)
 
 """# Saving Model"""
 
-# Save the fine-tuned model
-torch.save(fine_tuned_model.state_dict(), '3.pth')
+# Save only the soft prompt, the GPT-2 weights are unchanged
+save_soft_prompt(fine_tuned_model, '3.pth', soft_prompt_vocab, MAX_LEN)
 
 """# Loading Model"""
 
-# Initialize a new instance of the model
-model = GPT2WithSoftPrompt(MODEL_NAME, num_prompts).to(device)
-
-# Load the saved model state_dict
-model.load_state_dict(torch.load('3.pth'))
+# Attach the saved soft prompt to the GPT-2 backbone that is already in memory
+# (in a fresh session pass GPT2LMHeadModel.from_pretrained(MODEL_NAME) instead)
+model = load_soft_prompt('3.pth', fine_tuned_model.gpt2, precision=PRECISION).to(device)
 
 # Make sure the model is in evaluation mode after loading
 model.eval()
 
+"""# Quantized Inference"""
+
+# Dynamic int8 transformer blocks for CPU serving, the soft prompt stays fp32
+quantized_model = load_soft_prompt('3.pth', quantize_backbone(fine_tuned_model.gpt2)).eval()
+
+# Parity report against the fp32 model on the test split
+parity_loader = make_dataloader(tokenized_articles_test, tokenized_summaries_test, BATCH_SIZE, tokenizer.eos_token_id, num_prompts)
+print("Int8 vs fp32 : ", compare_models(model, quantized_model, parity_loader, prompt_id, ignore_index=tokenizer.eos_token_id))
+
 """# Inference"""
 
 # Set the model to evaluation mode
 model.eval()
 
+# Optionally serve from compiled graphs; warm-up builds or loads every shape bucket up front
+inference_model = model
+if COMPILED_INFERENCE:
+    set_inductor_cache_dir(COMPILED_CACHE_DIR)
+    inference_model = CompiledSoftPrompt(model, prompt_id.to(device), cache_dir=COMPILED_CACHE_DIR, pad_token_id=tokenizer.eos_token_id)
+    print("Warm-up (s) : ", inference_model.warmup())
+
 # Input text for summarization
 input_text = "Madam President, on a point of order."
 
@@ -325,28 +301,35 @@ input_ids = torch.tensor(input_ids)
 # Generate a summary
 with torch.no_grad():
     # Assuming single prompt
-    outputs = model(input_ids.to(device), prompt_ids=prompt_id.to(device))
-    pred_logits = outputs.logits
-    print(pred_logits.shape)
+    hidden_states = inference_model(input_ids.to(device), prompt_ids=prompt_id.to(device), positions=None).hidden_states
+    print(hidden_states.shape)
 
 
-# Get the token IDs with the highest probability for each position
-predicted_token_ids = torch.argmax(pred_logits, dim=-1)
+# Get the token IDs with the highest probability for each position, without materializing the logits
+predicted_token_ids = model.lm_argmax(hidden_states)
 
 # Convert token IDs into words using the tokenizer
 predicted_tokens = tokenizer.decode(predicted_token_ids.squeeze(0), skip_special_tokens=True)
 
 predicted_tokens
 
+"""# Generation"""
+
+# Generate a translation token by token, reusing the KV cache between steps
+with torch.no_grad():
+    generated_ids = model.generate(input_ids.to(device), prompt_id.to(device), max_new_tokens=60, eos_token_id=tokenizer.eos_token_id, num_beams=4)
+
+# Convert the generated token IDs into words
+tokenizer.decode(generated_ids, skip_special_tokens=True)
+
 """# Hard Prompt"""
 
 import torch
-from torch.utils.data import DataLoader, TensorDataset
-from transformers import GPT2LMHeadModel, GPT2Tokenizer
+from soft_prompt import GPT2WithSoftPrompt
+from data_utils import ParallelCorpus, batch_encode, cached_tokenize, get_tokenizer, make_dataloader
+from metrics import MetricAccumulator, MetricWorkerPool
 import pandas as pd
 from datasets import load_dataset
-import nltk
-from nltk.translate.bleu_score import corpus_bleu
 
 
 # Constants
@@ -355,6 +338,16 @@ BATCH_SIZE = 1
 EPOCHS = 1
 PROMPT_TOKEN = "Translate the following sentence from english to german :"
 MAX_LEN = 500
+PRECISION = "fp32"  # "bf16" runs the frozen GPT-2 under bfloat16 autocast, e.g. on AVX512-BF16/AMX CPUs
+TOKENIZER_WORKERS = 0  # > 1 spreads tokenization over a process pool
+TOKEN_CACHE_DIR = "token_cache"  # None disables the on-disk token cache
+DATALOADER_WORKERS = 2  # Processes collating batches ahead of the model, 0 collates in the main process
+PIN_MEMORY = False  # Everything below runs on the CPU
+METRIC_WORKERS = 2  # Processes decoding and scoring BLEU off the model loop, 0 scores inline
+NUM_SENTENCE_PAIRS = 150
+SAMPLE_PAIRS = False  # A seeded random sample of NUM_SENTENCE_PAIRS instead of the first ones
+DATA_SEED = 0
+BLEU_ON_TOKEN_IDS = False  # Score GPT-2 token ids instead of decoded words: faster, but not comparable to word-level BLEU
 
 # Soft Prompt Vocabulary
 soft_prompt_vocab = ["Translate","the","following","sentence","from","english","to","german",":"]  # Define your custom vocabulary here
@@ -365,56 +358,33 @@ soft_prompt_word2idx = {word: idx for idx, word in enumerate(soft_prompt_vocab)}
 num_prompts = len([soft_prompt_word2idx[word] for word in PROMPT_TOKEN.split()])
 prompt_id = torch.tensor([soft_prompt_word2idx[word] for word in PROMPT_TOKEN.split()])
 
-# Model Architecture
-class GPT2WithSoftPrompt(torch.nn.Module):
-    def __init__(self, model_name, num_prompts, embedding_size=768):
-        super().__init__()
-        self.gpt2 = GPT2LMHeadModel.from_pretrained(model_name)
-        self.soft_prompt = torch.nn.Embedding(num_prompts, embedding_size)
-
-    def forward(self, input_ids, prompt_ids):
-        prompt_embeddings = self.soft_prompt(prompt_ids)
-        base_embeddings = self.gpt2.transformer.wte(input_ids)
-        embeddings = torch.cat([prompt_embeddings, base_embeddings.squeeze(0)], dim=0)
-        outputs = self.gpt2(inputs_embeds=embeddings)
-        return outputs
-
 
 def load_data_from_files(english_file, german_file):
-    with open(english_file, "r", encoding="utf-8") as eng_file:
-        english_list = eng_file.readlines()
-
-    with open(german_file, "r", encoding="utf-8") as ger_file:
-        german_list = ger_file.readlines()
-
-    return english_list[:1500], german_list[:150]
+    # Seeks to the wanted lines through a byte-offset index of both files (built once and kept
+    # in TOKEN_CACHE_DIR) instead of reading the whole corpus
+    corpus = ParallelCorpus(english_file, german_file, cache_dir=TOKEN_CACHE_DIR)
+    if SAMPLE_PAIRS:
+        return corpus.sample(NUM_SENTENCE_PAIRS, seed=DATA_SEED)
+    return corpus.read(0, NUM_SENTENCE_PAIRS)
 
 
 # Data Loading and Preprocessing
 def load_and_preprocess_data(english_file, german_file, num_prompts):
-    english_list, german_list = load_data_from_files(english_file, german_file)
-
-    # Perform preprocessing on the data
-    tokenized_english = []
-    tokenized_german = []
-
-    tokenizer = GPT2Tokenizer.from_pretrained(MODEL_NAME)
+    def tokenize():
+        english_list, german_list = load_data_from_files(english_file, german_file)
 
-    for english_sentence, german_sentence in zip(english_list, german_list):
-        english_tokens = tokenizer.encode(english_sentence, truncation=True, max_length=MAX_LEN)
-        german_tokens = tokenizer.encode(german_sentence, truncation=True, max_length=MAX_LEN)
+        # Perform preprocessing on the data, a whole list per call on the fast tokenizer.
+        # Padding is added per batch by SoftPromptCollator.
+        tokenized_english = batch_encode(english_list, MODEL_NAME, max_length=MAX_LEN, num_workers=TOKENIZER_WORKERS)
+        tokenized_german = batch_encode(german_list, MODEL_NAME, max_length=MAX_LEN, num_workers=TOKENIZER_WORKERS)
+        return tokenized_english, tokenized_german
 
-        # Pad the sequences to MAX_LEN
-        padded_english = english_tokens + [tokenizer.eos_token_id] * (MAX_LEN - len(english_tokens))
-        padded_german = german_tokens + [tokenizer.eos_token_id] * (MAX_LEN+9 - len(german_tokens))
-
-        tokenized_english.append(padded_english)
-        tokenized_german.append(padded_german)
-
-    return tokenized_english, tokenized_german
+    # Repeat runs read the memory-mapped token cache instead of the corpus
+    settings = {"max_length": MAX_LEN, "num_sentence_pairs": NUM_SENTENCE_PAIRS, "sample_seed": DATA_SEED if SAMPLE_PAIRS else None}
+    return cached_tokenize(TOKEN_CACHE_DIR, "europarl", [english_file, german_file], MODEL_NAME, settings, tokenize)
 
 # Load and preprocess the data
-tokenizer = GPT2Tokenizer.from_pretrained(MODEL_NAME)
+tokenizer = get_tokenizer(MODEL_NAME)
 
 tokenized_articles_total , tokenized_summaries_total = load_and_preprocess_data("europarl-v7.de-en.en", "europarl-v7.de-en.de",num_prompts)
 total_samples = len(tokenized_articles_total)
@@ -439,52 +409,38 @@ device = "cpu"
 
 
 # # Model Initialization
-model = GPT2WithSoftPrompt(MODEL_NAME, num_prompts).to(device)
+model = GPT2WithSoftPrompt(MODEL_NAME, num_prompts, precision=PRECISION).to(device)
 
-from torch.nn import CrossEntropyLoss
 from tqdm import tqdm
 
 # Testing
 model.eval()
-test_pred_sentences = []
-test_true_sentences = []
-total_test_loss = 0
+text_metrics = MetricWorkerPool("bleu", MODEL_NAME, ignore_ids=[tokenizer.eos_token_id], num_workers=METRIC_WORKERS, decode=not BLEU_ON_TOKEN_IDS)
 with torch.no_grad():
-    test_percentage_matched = 0
-    test_percentage_matched_ct = 0
-    for article, summary in tqdm(zip(tokenized_articles_test, tokenized_summaries_test), total=len(tokenized_articles_test), desc="Validation", unit="batch"):
-        input_ids = torch.tensor(article).to(device)
-        labels = torch.tensor(summary).to(device)
-        outputs = model(input_ids, prompt_id)
-
-        # Bleu Score
-        pred_logits = outputs.logits
-        predicted_token_ids = torch.argmax(pred_logits, dim=-1)
-        predicted_tokens = tokenizer.decode(predicted_token_ids, skip_special_tokens=True)
-        test_pred_sentences.append(predicted_tokens.split())
-        predicted_tokens = tokenizer.decode(labels, skip_special_tokens=True)
-        test_true_sentences.append(predicted_tokens.split())
-
+    test_metrics = MetricAccumulator(device)
+    test_loader = make_dataloader(tokenized_articles_test, tokenized_summaries_test, BATCH_SIZE, tokenizer.eos_token_id, num_prompts, num_workers=DATALOADER_WORKERS, pin_memory=PIN_MEMORY)
+    for input_ids, attention_mask, labels in tqdm(test_loader, total=len(test_loader), desc="Validation", unit="batch"):
+        input_ids = input_ids.to(device, non_blocking=True)
+        attention_mask = attention_mask.to(device, non_blocking=True)
+        labels = labels.to(device, non_blocking=True)
+        hidden_states = model.hidden_states(input_ids, prompt_id, attention_mask=attention_mask)
         ignore_index = tokenizer.eos_token_id if tokenizer.eos_token_id is not None else -100
-        test_loss = CrossEntropyLoss(ignore_index=ignore_index)(outputs.logits, labels)
-        total_test_loss += test_loss.item()
+        # Only the positions with a real label go through the LM head
+        predictions = model.lm_argmax(hidden_states, positions=labels != ignore_index, fill_value=ignore_index)
 
-        # Metrics
-        set1 = set(torch.argmax(outputs.logits, dim=1).cpu().numpy())
-        set2 = set(labels.cpu().numpy())
+        # Bleu Score, scored off-thread
+        text_metrics.submit(predictions, labels)
 
-        # Calculate the intersection of sets
-        intersection = set1.intersection(set2)
+        test_loss = model.lm_loss(hidden_states, labels, ignore_index=ignore_index)
 
-        # Calculate the percentage of indices in the first tensor that are also in the second tensor
-        percentage = (len(intersection) / len(set1)) * 100
-        test_percentage_matched += percentage
-        test_percentage_matched_ct += 1
+        # Metrics, accumulated on the device
+        test_metrics.update(predictions, labels, test_loss, ignore_index=ignore_index)
 
 
-print("Test : % Exact Match: ",test_percentage_matched/test_percentage_matched_ct)
-avg_test_loss = total_test_loss / len(tokenized_summaries_test)
+test_results = test_metrics.compute()
+print("Test : % Exact Match: ", test_results["overlap"])
+avg_test_loss = test_results["loss"]
 print("Test Loss : ",avg_test_loss)
-bleu_score = corpus_bleu(test_true_sentences, test_pred_sentences)
+bleu_score = text_metrics.compute()
 print(f'Test BLEU Score: {bleu_score}')
-
+text_metrics.close()
@@ -7,9 +7,12 @@ Original file is located at
     https://colab.research.google.com/drive/1qE78ac4ohf7OFXE9K9iTaeQzfx627aWD
 """
 
+import os
 import torch
-from transformers import GPT2LMHeadModel, GPT2Tokenizer
-import json
+from soft_prompt import CompiledSoftPrompt, GPT2WithSoftPrompt, load_soft_prompt, quantize_backbone, save_soft_prompt, set_inductor_cache_dir
+from data_utils import batch_encode, cached_tokenize, context_question_column, get_tokenizer, iter_squad, make_dataloader
+from metrics import MetricAccumulator, MetricWorkerPool, compare_models
+import itertools
 
 # Constants
 MODEL_NAME = "gpt2"
@@ -17,6 +20,18 @@ BATCH_SIZE = 1
 EPOCHS = 1
 PROMPT_TOKEN = "[QUESTIONANSWERING]"
 MAX_LEN = 512
+PRECISION = "fp32"  # "bf16" runs the frozen GPT-2 under bfloat16 autocast, e.g. on AVX512-BF16/AMX CPUs
+GRADIENT_CHECKPOINTING = False  # recompute the GPT-2 blocks in backward: far less activation memory for about one extra forward
+COMPILED_INFERENCE = False  # run the Inference cells through exported + torch.compile graphs, one per shape bucket
+COMPILED_CACHE_DIR = "compiled_cache"  # exported graphs and compiled kernels, reused by later runs
+TOKENIZER_WORKERS = 0  # > 1 spreads tokenization over a process pool
+TOKEN_CACHE_DIR = "token_cache"  # None disables the on-disk token cache
+DATALOADER_WORKERS = 2  # Processes collating batches ahead of the model, 0 collates in the main process
+PIN_MEMORY = torch.cuda.is_available()  # Page-locked batches for asynchronous copies to the GPU
+METRICS_LOG_INTERVAL = 0  # Training steps between metric read-backs, 0 reads them once per epoch
+METRIC_WORKERS = 2  # Processes decoding and scoring SQuAD EM/F1 off the model loop, 0 scores inline
+NUM_PARAGRAPHS = 500  # None reads every paragraph
+PARAGRAPH_CHUNK_SIZE = 1000  # Paragraphs tokenized and written to the token cache at a time
 
 # Soft Prompt Vocabulary
 soft_prompt_vocab = ["[QUESTIONANSWERING]"]
@@ -27,66 +42,45 @@ soft_prompt_word2idx = {word: idx for idx, word in enumerate(soft_prompt_vocab)}
 num_prompts = len([soft_prompt_word2idx[word] for word in PROMPT_TOKEN.split()])
 prompt_id = torch.tensor([soft_prompt_word2idx[word] for word in PROMPT_TOKEN.split()])
 
-# Model Architecture
-class GPT2WithSoftPrompt(torch.nn.Module):
-    def __init__(self, model_name, num_prompts, embedding_size=768):
-        super().__init__()
-        self.gpt2 = GPT2LMHeadModel.from_pretrained(model_name)
-        self.soft_prompt = torch.nn.Embedding(num_prompts, embedding_size)
-
-    def forward(self, input_ids, prompt_ids):
-        prompt_embeddings = self.soft_prompt(prompt_ids)
-        base_embeddings = self.gpt2.transformer.wte(input_ids)
-        embeddings = torch.cat([prompt_embeddings, base_embeddings.squeeze(0)], dim=0)
-        outputs = self.gpt2(inputs_embeds=embeddings)
-        return outputs
-
-
-# Load data from a JSON file
-def load_data_from_json(json_file):
-    with open(json_file, "r", encoding="utf-8") as file:
-        data = json.load(file)
-
-    context_list = [dp["context"] for item in data["data"] for dp in item["paragraphs"]]
-    question_list = [dp["qas"][0]["question"] for item in data["data"] for dp in item["paragraphs"]]
-    answer_list = [dp["qas"][0]["answers"][0]["text"] if dp["qas"] and dp["qas"][0]["answers"] else "" for item in data["data"] for dp in item["paragraphs"]]
-
-    return context_list[:500], question_list[:500], answer_list[:500]
 
 # Data Loading and Preprocessing
 def load_and_preprocess_data(json_file, num_prompts):
-    context_list, question_list, answer_list = load_data_from_json(json_file)
-
-    # Perform preprocessing on the data
-    tokenized_question = []
-    tokenized_answer = []
-
-    tokenizer = GPT2Tokenizer.from_pretrained(MODEL_NAME)
-
-    for context, question, answer in zip(context_list, question_list, answer_list):
-        # Tokenize context, question, and answer using the GPT-2 tokenizer
-        context_tokens = tokenizer.encode(context, truncation=True, max_length=MAX_LEN)
-        question_tokens = tokenizer.encode(question, truncation=True, max_length=MAX_LEN)
-        answer_tokens = tokenizer.encode(answer, truncation=True, max_length=MAX_LEN)
-
-        padded_article = question_tokens + [tokenizer.eos_token_id] * (MAX_LEN-1 - len(question_tokens))
-        padded_summary = answer_tokens + [tokenizer.eos_token_id] * (MAX_LEN - len(answer_tokens))
-
-        tokenized_question.append(padded_article)
-        tokenized_answer.append(padded_summary)
-
-    return tokenized_question, tokenized_answer
+    # Each input is the question followed by the paragraph context, within MAX_LEN
+    max_length = MAX_LEN - num_prompts
+
+    def encode(paragraphs):
+        # Every question of a paragraph is kept; its context is tokenized once and shared.
+        # Padding is added per batch by SoftPromptCollator.
+        contexts = [context for context, qas in paragraphs]
+        questions = [question for context, qas in paragraphs for question, answer in qas]
+        answers = [answer for context, qas in paragraphs for question, answer in qas]
+        question_counts = [[len(qas)] for context, qas in paragraphs]
+        tokenized_contexts = batch_encode(contexts, MODEL_NAME, max_length=max_length, num_workers=TOKENIZER_WORKERS)
+        tokenized_questions = batch_encode(questions, MODEL_NAME, max_length=max_length, num_workers=TOKENIZER_WORKERS)
+        tokenized_answers = batch_encode(answers, MODEL_NAME, max_length=MAX_LEN, num_workers=TOKENIZER_WORKERS)
+        return tokenized_contexts, tokenized_questions, tokenized_answers, question_counts
+
+    def tokenize():
+        # The JSON is parsed one article at a time and tokenized PARAGRAPH_CHUNK_SIZE paragraphs at a time
+        paragraphs = itertools.islice(iter_squad(json_file), NUM_PARAGRAPHS)
+        while chunk := list(itertools.islice(paragraphs, PARAGRAPH_CHUNK_SIZE)):
+            yield encode(chunk)
+
+    # Repeat runs read the memory-mapped token cache instead of the JSON
+    settings = {"max_length": MAX_LEN, "num_prompts": num_prompts, "num_paragraphs": NUM_PARAGRAPHS, "inputs": "question+context", "questions": "answerable"}
+    contexts, questions, answers, question_counts = cached_tokenize(TOKEN_CACHE_DIR, "squad-" + os.path.basename(json_file), [json_file], MODEL_NAME, settings, tokenize)
+    return context_question_column(contexts, questions, question_counts, max_length), answers
 
 
 # Load and preprocess the data
-tokenizer = GPT2Tokenizer.from_pretrained(MODEL_NAME)
+tokenizer = get_tokenizer(MODEL_NAME)
 tokenized_articles_train,tokenized_summaries_train = load_and_preprocess_data("train-v2.0.json",num_prompts)
 tokenized_articles_validation,tokenized_summaries_validation = load_and_preprocess_data("dev-v2.0.json", num_prompts)
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
 
 # # Model Initialization
-model = GPT2WithSoftPrompt(MODEL_NAME, num_prompts).to(device)
+model = GPT2WithSoftPrompt(MODEL_NAME, num_prompts, precision=PRECISION, gradient_checkpointing=GRADIENT_CHECKPOINTING).to(device)
 
 from tqdm import tqdm
 
@@ -98,7 +92,6 @@ GRADIENT_CLIP_NORM = 1.0
 EARLY_STOPPING_PATIENCE = 2
 prompt_id = prompt_id.to(device)
 
-from torch.nn import CrossEntropyLoss
 
 def fine_tune_on_summarization(model, train_articles, train_summaries, val_articles, val_summaries):
     optimizer = torch.optim.Adam(model.soft_prompt.parameters())
@@ -106,78 +99,82 @@ def fine_tune_on_summarization(model, train_articles, train_summaries, val_artic
     best_val_loss = float('inf')
     no_improvement_epochs = 0
 
+    # Built once: the persistent workers are reused by every epoch
+    train_loader = make_dataloader(train_articles, train_summaries, BATCH_SIZE, tokenizer.eos_token_id, num_prompts, shuffle=True, num_workers=DATALOADER_WORKERS, pin_memory=PIN_MEMORY)
+    val_loader = make_dataloader(val_articles, val_summaries, BATCH_SIZE, tokenizer.eos_token_id, num_prompts, num_workers=DATALOADER_WORKERS, pin_memory=PIN_MEMORY)
+    # Decoded-text metrics run in background processes and are merged at the end of each epoch
+    text_metrics = MetricWorkerPool("squad", MODEL_NAME, ignore_ids=[tokenizer.eos_token_id], num_workers=METRIC_WORKERS)
+
     for epoch in range(EPOCHS):
         model.train()
 
         # Gradient accumulation initialization
         optimizer.zero_grad()
-        accumulated_loss = 0
-        loss = 0
+        window_tokens = 0
         # Use tqdm for progress bar
-        with tqdm(enumerate(zip(train_articles, train_summaries)), total=len(train_articles), desc=f"Epoch {epoch + 1}/{EPOCHS}", unit="batch") as progress:
-            train_percentage_matched = 0
-            train_percentage_matched_ct = 0
-            for idx, (article, summary) in progress:
-                input_ids = torch.tensor(article).to(device)
-                labels = torch.tensor(summary).to(device)
-                outputs = model(input_ids, prompt_id)
+        train_loader.batch_sampler.set_epoch(epoch)
+        with tqdm(enumerate(train_loader), total=len(train_loader), desc=f"Epoch {epoch + 1}/{EPOCHS}", unit="batch") as progress:
+            train_metrics = MetricAccumulator(device)
+            for idx, (input_ids, attention_mask, labels) in progress:
+                input_ids = input_ids.to(device, non_blocking=True)
+                attention_mask = attention_mask.to(device, non_blocking=True)
+                labels = labels.to(device, non_blocking=True)
+                # Hidden states only: the LM head is applied in chunks by lm_loss/lm_argmax, never to all positions at once
+                hidden_states = model.hidden_states(input_ids, prompt_id, attention_mask=attention_mask)
 
                 ignore_index = tokenizer.eos_token_id
-                loss += CrossEntropyLoss(ignore_index=ignore_index)(outputs.logits, labels)
-
-                # Metrics
-                set1 = set(torch.argmax(outputs.logits, dim=1).cpu().numpy())
-                set2 = set(labels.cpu().numpy())
-
-                # Calculate the intersection of sets
-                intersection = set1.intersection(set2)
-
-                # Calculate the percentage of indices in the first tensor that are also in the second tensor
-                percentage = (len(intersection) / len(set1)) * 100
-                train_percentage_matched += percentage
-                train_percentage_matched_ct += 1
-
-                # Backpropagate losses every GRADIENT_ACCUMULATION_STEPS or at the end of the dataset
-                if (idx + 1) % GRADIENT_ACCUMULATION_STEPS == 0 or idx == len(train_articles) - 1:
-                    (loss / GRADIENT_ACCUMULATION_STEPS).backward()
-                    torch.nn.utils.clip_grad_norm_(model.parameters(), GRADIENT_CLIP_NORM)
+                predictions = model.lm_argmax(hidden_states, positions=labels != ignore_index, fill_value=ignore_index)
+                # Each micro-step backpropagates its summed token loss right away, so its graph is freed
+                # before the next one; the gradients are divided by the window's real label count below
+                step_loss_sum = model.lm_loss(hidden_states, labels, ignore_index=ignore_index, reduction="sum")
+                step_loss_sum.backward()
+                step_tokens = (labels != ignore_index).sum()
+                window_tokens += step_tokens
+                step_loss = step_loss_sum.detach() / step_tokens
+
+                # Metrics, accumulated on the device
+                train_metrics.update(predictions, labels, step_loss, ignore_index=ignore_index)
+                if METRICS_LOG_INTERVAL and (idx + 1) % METRICS_LOG_INTERVAL == 0:
+                    progress.set_postfix(train_metrics.compute())
+
+                # Update every GRADIENT_ACCUMULATION_STEPS or at the end of the dataset, with the mean
+                # loss gradient over every real label token of the window
+                if (idx + 1) % GRADIENT_ACCUMULATION_STEPS == 0 or idx == len(train_loader) - 1:
+                    for param in model.soft_prompt.parameters():
+                        param.grad.div_(window_tokens.clamp(min=1))
+                    torch.nn.utils.clip_grad_norm_(model.soft_prompt.parameters(), GRADIENT_CLIP_NORM)
                     optimizer.step()
                     optimizer.zero_grad()
-                    loss = 0
+                    window_tokens = 0
 
-            print("Train : % Exact Match: ",train_percentage_matched/train_percentage_matched_ct)
+            train_results = train_metrics.compute()
+            print("Train : % Exact Match: ", train_results["overlap"])
 
         # Validation
         model.eval()
-        total_val_loss = 0
         with torch.no_grad():
-            val_percentage_matched = 0
-            val_percentage_matched_ct = 0
-            for article, summary in tqdm(zip(val_articles, val_summaries), total=len(val_articles), desc="Validation", unit="batch"):
-                input_ids = torch.tensor(article).to(device)
-                labels = torch.tensor(summary).to(device)
-                outputs = model(input_ids, prompt_id)
-
+            val_metrics = MetricAccumulator(device)
+            for input_ids, attention_mask, labels in tqdm(val_loader, total=len(val_loader), desc="Validation", unit="batch"):
+                input_ids = input_ids.to(device, non_blocking=True)
+                attention_mask = attention_mask.to(device, non_blocking=True)
+                labels = labels.to(device, non_blocking=True)
+                hidden_states = model.hidden_states(input_ids, prompt_id, attention_mask=attention_mask)
                 ignore_index = tokenizer.eos_token_id if tokenizer.eos_token_id is not None else -100
-                val_loss = CrossEntropyLoss(ignore_index=ignore_index)(outputs.logits, labels)
-                total_val_loss += val_loss.item()
-
-                # Metrics
-                set1 = set(torch.argmax(outputs.logits, dim=1).cpu().numpy())
-                set2 = set(labels.cpu().numpy())
+                # Only the positions with a real label go through the LM head
+                predictions = model.lm_argmax(hidden_states, positions=labels != ignore_index, fill_value=ignore_index)
 
-                # Calculate the intersection of sets
-                intersection = set1.intersection(set2)
+                val_loss = model.lm_loss(hidden_states, labels, ignore_index=ignore_index)
 
-                # Calculate the percentage of indices in the first tensor that are also in the second tensor
-                percentage = (len(intersection) / len(set1)) * 100
-                val_percentage_matched += percentage
-                val_percentage_matched_ct += 1
+                # Metrics, accumulated on the device
+                val_metrics.update(predictions, labels, val_loss, ignore_index=ignore_index)
+                text_metrics.submit(predictions, labels)
 
 
-        print("Val : % Exact Match: ",val_percentage_matched/val_percentage_matched_ct)
-        avg_val_loss = total_val_loss / len(val_articles)
+        val_results = val_metrics.compute()
+        print("Val : % Exact Match: ", val_results["overlap"])
+        avg_val_loss = val_results["loss"]
         print("Val Loss : ",avg_val_loss)
+        print("Val SQuAD EM/F1 : ", text_metrics.compute())
 
         # Early stopping
         if avg_val_loss < best_val_loss:
@@ -189,31 +186,46 @@ def fine_tune_on_summarization(model, train_articles, train_summaries, val_artic
                 print(f"Early stopping after {EARLY_STOPPING_PATIENCE} epochs without improvement.")
                 break
 
+    text_metrics.close()
     return model
 
 fine_tuned_model = fine_tune_on_summarization(model, tokenized_articles_train, tokenized_summaries_train, tokenized_articles_validation, tokenized_summaries_validation)
 
 """# Saving Model"""
 
-# Save the fine-tuned model
-torch.save(fine_tuned_model.state_dict(), '2.pth')
+# Save only the soft prompt, the GPT-2 weights are unchanged
+save_soft_prompt(fine_tuned_model, '2.pth', soft_prompt_vocab, MAX_LEN)
 
 """# Loading Model"""
 
-# Initialize a new instance of the model
-model = GPT2WithSoftPrompt(MODEL_NAME, num_prompts).to(device)
-
-# Load the saved model state_dict
-model.load_state_dict(torch.load('2.pth'))
+# Attach the saved soft prompt to the GPT-2 backbone that is already in memory
+# (in a fresh session pass GPT2LMHeadModel.from_pretrained(MODEL_NAME) instead)
+model = load_soft_prompt('2.pth', fine_tuned_model.gpt2, precision=PRECISION).to(device)
 
 # Make sure the model is in evaluation mode after loading
 model.eval()
 
+"""# Quantized Inference"""
+
+# Dynamic int8 transformer blocks for CPU serving, the soft prompt stays fp32
+quantized_model = load_soft_prompt('2.pth', quantize_backbone(fine_tuned_model.gpt2)).eval()
+
+# Parity report against the fp32 model on the validation split
+parity_loader = make_dataloader(tokenized_articles_validation, tokenized_summaries_validation, BATCH_SIZE, tokenizer.eos_token_id, num_prompts)
+print("Int8 vs fp32 : ", compare_models(model, quantized_model, parity_loader, prompt_id, ignore_index=tokenizer.eos_token_id))
+
 """# Inference"""
 
 # Set the model to evaluation mode
 model.eval()
 
+# Optionally serve from compiled graphs; warm-up builds or loads every shape bucket up front
+inference_model = model
+if COMPILED_INFERENCE:
+    set_inductor_cache_dir(COMPILED_CACHE_DIR)
+    inference_model = CompiledSoftPrompt(model, prompt_id.to(device), cache_dir=COMPILED_CACHE_DIR, pad_token_id=tokenizer.eos_token_id)
+    print("Warm-up (s) : ", inference_model.warmup())
+
 # Input text for summarization
 input_text = "Sally Forrest, an actress-dancer who graced the silver screen throughout the '40s and '50s in MGM musicals and films such as the 1956 noir While the City Sleeps died on March 15 at her home in Beverly Hills, California. Forrest, whose birth name was Katherine Feeney, was 86 and had long battled cancer. Her publicist, Judith Goffin, announced the news Thursday. Scroll down for video . Actress: Sally Forrest was in the 1951 Ida Lupino-directed film 'Hard, Fast and Beautiful' (left) and the 1956 Fritz Lang movie 'While the City Sleeps' A San Diego native, Forrest became a protege of Hollywood trailblazer Ida Lupino, who cast her in starring roles in films including the critical and commercial success Not Wanted, Never Fear and Hard, Fast and Beautiful. Some of Forrest's other film credits included Bannerline, Son of Sinbad, and Excuse My Dust, according to her iMDB page. The page also indicates Forrest was in multiple Climax! and Rawhide television episodes. Forrest appeared as herself in an episode of The Ed Sullivan Show and three episodes of The Dinah Shore Chevy Show, her iMDB page says. She also starred in a Broadway production of The Seven Year Itch. City News Service reported that other stage credits included As You Like It, No, No, Nanette and Damn Yankees. Forrest married writer-producer Milo Frank in 1951. He died in 2004. She is survived by her niece, Sharon Durham, and nephews, Michael and Mark Feeney. Career: A San Diego native, Forrest became a protege of Hollywood trailblazer Ida Lupino, who cast her in starring roles in films ."
 
@@ -226,24 +238,35 @@ input_ids = torch.tensor(input_ids)
 # Generate a summary
 with torch.no_grad():
     # Assuming single prompt
-    outputs = model(input_ids.to(device), prompt_ids=prompt_id.to(device))
-    pred_logits = outputs.logits
-    print(pred_logits.shape)
+    hidden_states = inference_model(input_ids.to(device), prompt_ids=prompt_id.to(device), positions=None).hidden_states
+    print(hidden_states.shape)
 
 
-# Get the token IDs with the highest probability for each position
-predicted_token_ids = torch.argmax(pred_logits, dim=-1)
+# Get the token IDs with the highest probability for each position, without materializing the logits
+predicted_token_ids = model.lm_argmax(hidden_states)
 
 # Convert token IDs into words using the tokenizer
 predicted_tokens = tokenizer.decode(predicted_token_ids.squeeze(0), skip_special_tokens=True)
 
 predicted_tokens
 
+"""# Generation"""
+
+# Generate a answer token by token, reusing the KV cache between steps
+with torch.no_grad():
+    generated_ids = model.generate(input_ids.to(device), prompt_id.to(device), max_new_tokens=30, eos_token_id=tokenizer.eos_token_id, num_beams=4)
+
+# Convert the generated token IDs into words
+tokenizer.decode(generated_ids, skip_special_tokens=True)
+
 """# Hard Prompt"""
 
+import os
 import torch
-from transformers import GPT2LMHeadModel, GPT2Tokenizer
-import json
+from soft_prompt import GPT2WithSoftPrompt
+from data_utils import batch_encode, cached_tokenize, context_question_column, get_tokenizer, iter_squad, make_dataloader
+from metrics import MetricAccumulator, MetricWorkerPool
+import itertools
 
 # Constants
 MODEL_NAME = "gpt2"
@@ -251,6 +274,14 @@ BATCH_SIZE = 1
 EPOCHS = 1
 PROMPT_TOKEN = "Answer the Following Question"
 MAX_LEN = 512
+PRECISION = "fp32"  # "bf16" runs the frozen GPT-2 under bfloat16 autocast, e.g. on AVX512-BF16/AMX CPUs
+TOKENIZER_WORKERS = 0  # > 1 spreads tokenization over a process pool
+TOKEN_CACHE_DIR = "token_cache"  # None disables the on-disk token cache
+DATALOADER_WORKERS = 2  # Processes collating batches ahead of the model, 0 collates in the main process
+PIN_MEMORY = False  # Everything below runs on the CPU
+METRIC_WORKERS = 2  # Processes decoding and scoring SQuAD EM/F1 off the model loop, 0 scores inline
+NUM_PARAGRAPHS = 50  # None reads every paragraph
+PARAGRAPH_CHUNK_SIZE = 1000  # Paragraphs tokenized and written to the token cache at a time
 
 # Soft Prompt Vocabulary
 soft_prompt_vocab = ["Answer","the","Following","Question"]
@@ -261,96 +292,71 @@ soft_prompt_word2idx = {word: idx for idx, word in enumerate(soft_prompt_vocab)}
 num_prompts = len([soft_prompt_word2idx[word] for word in PROMPT_TOKEN.split()])
 prompt_id = torch.tensor([soft_prompt_word2idx[word] for word in PROMPT_TOKEN.split()])
 
-# Model Architecture
-class GPT2WithSoftPrompt(torch.nn.Module):
-    def __init__(self, model_name, num_prompts, embedding_size=768):
-        super().__init__()
-        self.gpt2 = GPT2LMHeadModel.from_pretrained(model_name)
-        self.soft_prompt = torch.nn.Embedding(num_prompts, embedding_size)
-
-    def forward(self, input_ids, prompt_ids):
-        prompt_embeddings = self.soft_prompt(prompt_ids)
-        base_embeddings = self.gpt2.transformer.wte(input_ids)
-        embeddings = torch.cat([prompt_embeddings, base_embeddings.squeeze(0)], dim=0)
-        outputs = self.gpt2(inputs_embeds=embeddings)
-        return outputs
-
-
-# Load data from a JSON file
-def load_data_from_json(json_file):
-    with open(json_file, "r", encoding="utf-8") as file:
-        data = json.load(file)
-
-    context_list = [dp["context"] for item in data["data"] for dp in item["paragraphs"]]
-    question_list = [dp["qas"][0]["question"] for item in data["data"] for dp in item["paragraphs"]]
-    answer_list = [dp["qas"][0]["answers"][0]["text"] if dp["qas"] and dp["qas"][0]["answers"] else "" for item in data["data"] for dp in item["paragraphs"]]
-
-    return context_list[:50], question_list[:50], answer_list[:50]
 
 # Data Loading and Preprocessing
 def load_and_preprocess_data(json_file, num_prompts):
-    context_list, question_list, answer_list = load_data_from_json(json_file)
-
-    # Perform preprocessing on the data
-    tokenized_question = []
-    tokenized_answer = []
-
-    tokenizer = GPT2Tokenizer.from_pretrained(MODEL_NAME)
-
-    for context, question, answer in zip(context_list, question_list, answer_list):
-        # Tokenize context, question, and answer using the GPT-2 tokenizer
-        context_tokens = tokenizer.encode(context, truncation=True, max_length=MAX_LEN)
-        question_tokens = tokenizer.encode(question, truncation=True, max_length=MAX_LEN)
-        answer_tokens = tokenizer.encode(answer, truncation=True, max_length=MAX_LEN)
-
-        padded_article = question_tokens + [tokenizer.eos_token_id] * (MAX_LEN - len(question_tokens))
-        padded_summary = answer_tokens + [tokenizer.eos_token_id] * (MAX_LEN+4 - len(answer_tokens))
-
-        tokenized_question.append(padded_article)
-        tokenized_answer.append(padded_summary)
-
-    return tokenized_question, tokenized_answer
+    # Each input is the question followed by the paragraph context, within MAX_LEN
+    max_length = MAX_LEN - num_prompts
+
+    def encode(paragraphs):
+        # Every question of a paragraph is kept; its context is tokenized once and shared.
+        # Padding is added per batch by SoftPromptCollator.
+        contexts = [context for context, qas in paragraphs]
+        questions = [question for context, qas in paragraphs for question, answer in qas]
+        answers = [answer for context, qas in paragraphs for question, answer in qas]
+        question_counts = [[len(qas)] for context, qas in paragraphs]
+        tokenized_contexts = batch_encode(contexts, MODEL_NAME, max_length=max_length, num_workers=TOKENIZER_WORKERS)
+        tokenized_questions = batch_encode(questions, MODEL_NAME, max_length=max_length, num_workers=TOKENIZER_WORKERS)
+        tokenized_answers = batch_encode(answers, MODEL_NAME, max_length=MAX_LEN, num_workers=TOKENIZER_WORKERS)
+        return tokenized_contexts, tokenized_questions, tokenized_answers, question_counts
+
+    def tokenize():
+        # The JSON is parsed one article at a time and tokenized PARAGRAPH_CHUNK_SIZE paragraphs at a time
+        paragraphs = itertools.islice(iter_squad(json_file), NUM_PARAGRAPHS)
+        while chunk := list(itertools.islice(paragraphs, PARAGRAPH_CHUNK_SIZE)):
+            yield encode(chunk)
+
+    # Repeat runs read the memory-mapped token cache instead of the JSON
+    settings = {"max_length": MAX_LEN, "num_prompts": num_prompts, "num_paragraphs": NUM_PARAGRAPHS, "inputs": "question+context", "questions": "answerable"}
+    contexts, questions, answers, question_counts = cached_tokenize(TOKEN_CACHE_DIR, "squad-" + os.path.basename(json_file), [json_file], MODEL_NAME, settings, tokenize)
+    return context_question_column(contexts, questions, question_counts, max_length), answers
 
 
 # Load and preprocess the data
-tokenizer = GPT2Tokenizer.from_pretrained(MODEL_NAME)
+tokenizer = get_tokenizer(MODEL_NAME)
 tokenized_articles_train,tokenized_summaries_train = load_and_preprocess_data("train-v2.0.json",num_prompts)
 tokenized_articles_validation,tokenized_summaries_validation = load_and_preprocess_data("dev-v2.0.json", num_prompts)
 device = "cpu"
 
 
 # # Model Initialization
-model = GPT2WithSoftPrompt(MODEL_NAME, num_prompts).to(device)
+model = GPT2WithSoftPrompt(MODEL_NAME, num_prompts, precision=PRECISION).to(device)
 
 # test
 model.eval()
-total_val_loss = 0
+text_metrics = MetricWorkerPool("squad", MODEL_NAME, ignore_ids=[tokenizer.eos_token_id], num_workers=METRIC_WORKERS)
 with torch.no_grad():
-    val_percentage_matched = 0
-    val_percentage_matched_ct = 0
-    for article, summary in tqdm(zip(tokenized_articles_validation, tokenized_summaries_validation), total=len(tokenized_articles_validation), desc="Validation", unit="batch"):
-        input_ids = torch.tensor(article).to(device)
-        labels = torch.tensor(summary).to(device)
-        outputs = model(input_ids, prompt_id)
-
+    val_metrics = MetricAccumulator(device)
+    validation_loader = make_dataloader(tokenized_articles_validation, tokenized_summaries_validation, BATCH_SIZE, tokenizer.eos_token_id, num_prompts, num_workers=DATALOADER_WORKERS, pin_memory=PIN_MEMORY)
+    for input_ids, attention_mask, labels in tqdm(validation_loader, total=len(validation_loader), desc="Validation", unit="batch"):
+        input_ids = input_ids.to(device, non_blocking=True)
+        attention_mask = attention_mask.to(device, non_blocking=True)
+        labels = labels.to(device, non_blocking=True)
+        hidden_states = model.hidden_states(input_ids, prompt_id, attention_mask=attention_mask)
         ignore_index = tokenizer.eos_token_id if tokenizer.eos_token_id is not None else -100
-        val_loss = CrossEntropyLoss(ignore_index=ignore_index)(outputs.logits, labels)
-        total_val_loss += val_loss.item()
+        # Only the positions with a real label go through the LM head
+        predictions = model.lm_argmax(hidden_states, positions=labels != ignore_index, fill_value=ignore_index)
 
-        # Metrics
-        set1 = set(torch.argmax(outputs.logits, dim=1).cpu().numpy())
-        set2 = set(labels.cpu().numpy())
+        val_loss = model.lm_loss(hidden_states, labels, ignore_index=ignore_index)
 
-        # Calculate the intersection of sets
-        intersection = set1.intersection(set2)
+        # Metrics, accumulated on the device
+        val_metrics.update(predictions, labels, val_loss, ignore_index=ignore_index)
+        text_metrics.submit(predictions, labels)
 
-        # Calculate the percentage of indices in the first tensor that are also in the second tensor
-        percentage = (len(intersection) / len(set1)) * 100
-        val_percentage_matched += percentage
-        val_percentage_matched_ct += 1
 
-
-print("Val : % Exact Match: ",val_percentage_matched/val_percentage_matched_ct)
-avg_val_loss = total_val_loss / len(tokenized_summaries_validation)
+val_results = val_metrics.compute()
+print("Val : % Exact Match: ", val_results["overlap"])
+avg_val_loss = val_results["loss"]
 print("Val Loss : ",avg_val_loss)
-
+print("Val SQuAD EM/F1 : ", text_metrics.compute())
+text_metrics.close()
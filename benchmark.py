@@ -0,0 +1,633 @@
+import argparse
+import json
+import multiprocessing
+import resource
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import torch
+from torch.nn import CrossEntropyLoss
+from transformers import GPT2Config, GPT2LMHeadModel
+
+from data_utils import make_dataloader
+from metrics import compare_models, token_overlap
+from soft_prompt import INFERENCE_BUCKETS, LM_HEAD_CHUNK_SIZE, LM_HEAD_VOCAB_CHUNK_SIZE, CompiledSoftPrompt, GPT2WithSoftPrompt, quantize_backbone, set_inductor_cache_dir
+
+
+# Random-weight backbones, so benchmarks never need network access or downloaded weights
+BACKBONE_CONFIGS = {
+    "tiny": dict(n_layer=2, n_head=2, n_embd=128),
+    "full": dict(),
+}
+
+
+# Synthetic data shaped like each task: total positions (prompt + input, MAX_LEN in the scripts),
+# real label tokens per example and new tokens per generate() call
+TASK_SHAPES = {
+    "summarization": dict(seq_len=1024, label_len=128, new_tokens=100),  # CNN/DailyMail
+    "translation": dict(seq_len=500, label_len=64, new_tokens=64),  # Europarl
+    "qa": dict(seq_len=512, label_len=16, new_tokens=16),  # SQuAD
+}
+SUITE_PHASES = ("train", "eval", "generate")
+
+
+def build_model(size="tiny", num_prompts=1, seed=0, **kwargs):
+    torch.manual_seed(seed)
+    config = GPT2Config(**BACKBONE_CONFIGS[size])
+    gpt2 = GPT2LMHeadModel(config)
+    # The backbone is built here, so it is frozen like a from_pretrained one unless asked otherwise
+    kwargs.setdefault("freeze_backbone", True)
+    return GPT2WithSoftPrompt(None, num_prompts, embedding_size=config.n_embd, gpt2=gpt2, **kwargs)
+
+
+def synthetic_batch(model, batch_size, seq_len, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    vocab_size = model.gpt2.config.vocab_size
+    num_prompts = model.soft_prompt.num_embeddings
+    input_ids = torch.randint(0, vocab_size, (batch_size, seq_len), generator=generator)
+    attention_mask = torch.ones_like(input_ids)
+    labels = torch.randint(0, vocab_size, (batch_size, num_prompts + seq_len), generator=generator)
+    return input_ids, attention_mask, labels
+
+
+class SavedTensorMeter:
+    # Counts the bytes autograd saves for backward, i.e. the activation memory of a step.
+    # Tensors sharing a storage are counted once and the model's own weights not at all.
+    def __init__(self, model):
+        self.parameters = {p.untyped_storage().data_ptr() for p in model.parameters()}
+        self.storages = {}
+
+    def pack(self, tensor):
+        storage = tensor.untyped_storage()
+        if storage.data_ptr() not in self.parameters:
+            self.storages[storage.data_ptr()] = storage.nbytes()
+        return tensor
+
+    @property
+    def nbytes(self):
+        return sum(self.storages.values())
+
+    def __enter__(self):
+        self.hooks = torch.autograd.graph.saved_tensors_hooks(self.pack, lambda tensor: tensor)
+        self.hooks.__enter__()
+        return self
+
+    def __exit__(self, *exc):
+        self.hooks.__exit__(*exc)
+
+
+def full_logits_loss(model, prompt_ids, input_ids, attention_mask, labels, ignore_index=-100):
+    outputs = model(input_ids, prompt_ids, attention_mask=attention_mask)
+    return CrossEntropyLoss(ignore_index=ignore_index)(outputs.logits.flatten(0, 1), labels.flatten())
+
+
+def chunked_loss(model, prompt_ids, input_ids, attention_mask, labels, ignore_index=-100):
+    hidden_states = model.hidden_states(input_ids, prompt_ids, attention_mask=attention_mask)
+    return model.lm_loss(hidden_states, labels, ignore_index=ignore_index)
+
+
+def train_step(model, optimizer, prompt_ids, input_ids, attention_mask, labels, ignore_index=-100, loss_fn=full_logits_loss):
+    loss = loss_fn(model, prompt_ids, input_ids, attention_mask, labels, ignore_index)
+    loss.backward()
+    torch.nn.utils.clip_grad_norm_([p for p in model.parameters() if p.requires_grad], 1.0)
+    optimizer.step()
+    optimizer.zero_grad()
+    return loss.detach()
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))]
+
+
+def round_floats(value, digits=4):
+    if isinstance(value, dict):
+        return {key: round_floats(item, digits) for key, item in value.items()}
+    return round(value, digits) if isinstance(value, float) else value
+
+
+def mb(nbytes):
+    return round(nbytes / 2 ** 20, 2)
+
+
+def peak_rss_mb():
+    # Peak resident set size of this process so far; ru_maxrss is in KB on Linux
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 2)
+
+
+def in_fresh_process(function, *args):
+    # Runs function(*args) in a new interpreter, so its peak RSS is not hidden by an earlier run
+    with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context("spawn")) as executor:
+        return executor.submit(function, *args).result()
+
+
+def benchmark_frozen_backbone(size, batch_size, seq_len, steps, warmup):
+    results = {}
+    for mode, freeze in [("trainable_backbone", False), ("frozen_backbone", True)]:
+        model = build_model(size, freeze_backbone=freeze)
+        model.train()
+        optimizer = torch.optim.Adam(model.soft_prompt.parameters())
+        prompt_ids = torch.arange(model.soft_prompt.num_embeddings)
+        batch = synthetic_batch(model, batch_size, seq_len)
+
+        for _ in range(warmup):
+            train_step(model, optimizer, prompt_ids, *batch)
+
+        with SavedTensorMeter(model) as meter:
+            outputs = model(batch[0], prompt_ids, attention_mask=batch[1])
+            loss = CrossEntropyLoss()(outputs.logits.flatten(0, 1), batch[2].flatten())
+        loss.backward()
+        grad_bytes = sum(p.grad.nbytes for p in model.parameters() if p.grad is not None)
+        optimizer.zero_grad()
+        del outputs, loss
+
+        latencies = []
+        for _ in range(steps):
+            start = time.perf_counter()
+            train_step(model, optimizer, prompt_ids, *batch)
+            latencies.append((time.perf_counter() - start) * 1000)
+
+        results[mode] = {
+            "saved_activations_mb": mb(meter.nbytes),
+            "gradients_mb": mb(grad_bytes),
+            "step_ms_mean": round(sum(latencies) / len(latencies), 2),
+            "step_ms_p50": round(percentile(latencies, 50), 2),
+        }
+
+    before, after = results["trainable_backbone"], results["frozen_backbone"]
+    results["savings"] = {
+        "memory_mb": round(before["saved_activations_mb"] + before["gradients_mb"] - after["saved_activations_mb"] - after["gradients_mb"], 2),
+        "step_speedup": round(before["step_ms_mean"] / after["step_ms_mean"], 2),
+    }
+    return results
+
+
+def evaluate(model, prompt_ids, input_ids, attention_mask, labels, ignore_index=-100):
+    # Loss and token overlap of one batch, plus the forward latency
+    model.eval()
+    with torch.no_grad():
+        start = time.perf_counter()
+        outputs = model(input_ids, prompt_ids, attention_mask=attention_mask)
+        latency = (time.perf_counter() - start) * 1000
+        loss = CrossEntropyLoss(ignore_index=ignore_index)(outputs.logits.flatten(0, 1), labels.flatten())
+        overlap = token_overlap(outputs.logits.argmax(dim=-1), labels).mean()
+    model.train()
+    return loss.item(), overlap.item(), latency
+
+
+def benchmark_precision(size, batch_size, seq_len, steps, warmup):
+    # Same initialization and data for both precisions: train the soft prompt, then compare the
+    # evaluation loss/overlap (parity) and the step and forward times (speed)
+    results = {"cpu_capability": torch.backends.cpu.get_cpu_capability()}
+    for precision in ["fp32", "bf16"]:
+        model = build_model(size, precision=precision)
+        model.train()
+        optimizer = torch.optim.Adam(model.soft_prompt.parameters())
+        prompt_ids = torch.arange(model.soft_prompt.num_embeddings)
+        batch = synthetic_batch(model, batch_size, seq_len)
+        eval_batch = synthetic_batch(model, batch_size, seq_len, seed=1)
+
+        latencies = []
+        for step in range(warmup + steps):
+            start = time.perf_counter()
+            loss = train_step(model, optimizer, prompt_ids, *batch)
+            if step >= warmup:
+                latencies.append((time.perf_counter() - start) * 1000)
+
+        eval_loss, eval_overlap, _ = evaluate(model, prompt_ids, *eval_batch)
+        forward_ms = [evaluate(model, prompt_ids, *eval_batch)[2] for _ in range(steps)]
+        step_ms = sum(latencies) / len(latencies)
+        results[precision] = {
+            "final_train_loss": round(loss.item(), 4),
+            "eval_loss": round(eval_loss, 4),
+            "eval_token_overlap": round(eval_overlap, 2),
+            "step_ms_mean": round(step_ms, 2),
+            "train_tokens_per_s": round(batch_size * seq_len / step_ms * 1000, 1),
+            "forward_ms_p50": round(percentile(forward_ms, 50), 2),
+            "soft_prompt_dtype": str(model.soft_prompt.weight.dtype),
+        }
+
+    fp32, bf16 = results["fp32"], results["bf16"]
+    results["comparison"] = {
+        "eval_loss_abs_diff": round(abs(fp32["eval_loss"] - bf16["eval_loss"]), 4),
+        "eval_token_overlap_abs_diff": round(abs(fp32["eval_token_overlap"] - bf16["eval_token_overlap"]), 2),
+        "train_speedup": round(fp32["step_ms_mean"] / bf16["step_ms_mean"], 2),
+        "forward_speedup": round(fp32["forward_ms_p50"] / bf16["forward_ms_p50"], 2),
+    }
+    return results
+
+
+def benchmark_quantized(size, batch_size, seq_len, batches):
+    # fp32 vs dynamic int8 backbone with the same soft prompt, on synthetic batches
+    model = build_model(size).eval()
+    quantized = GPT2WithSoftPrompt(None, model.soft_prompt.num_embeddings, embedding_size=model.gpt2.config.n_embd, gpt2=quantize_backbone(model.gpt2))
+    quantized.soft_prompt.load_state_dict(model.soft_prompt.state_dict())
+    quantized.eval()
+
+    inputs, labels = [], []
+    for seed in range(batches):
+        input_ids, _, batch_labels = synthetic_batch(model, batch_size, seq_len, seed=seed)
+        inputs.extend(input_ids.tolist())
+        labels.extend(batch_labels.tolist())
+    loader = make_dataloader(inputs, labels, batch_size, model.gpt2.config.eos_token_id, model.soft_prompt.num_embeddings)
+    report = compare_models(model, quantized, loader, torch.arange(model.soft_prompt.num_embeddings))
+    report["weights_ratio"] = report["reference"]["weights_mb"] / report["candidate"]["weights_mb"]
+    report["forward_speedup"] = report["reference"]["forward_ms_per_row"] / report["candidate"]["forward_ms_per_row"]
+    return round_floats(report)
+
+
+def benchmark_chunked_loss(size, batch_size, seq_len, label_len, steps, warmup):
+    # Full [B, P + T, V] logits + CrossEntropyLoss vs the chunked LM head loss, with only the
+    # last label_len label positions real and the rest ignored padding, as in the task scripts
+    results = {}
+    for mode, loss_fn in [("full_logits", full_logits_loss), ("chunked", chunked_loss)]:
+        model = build_model(size)
+        model.eval()  # no dropout, so both modes compute the same loss
+        optimizer = torch.optim.Adam(model.soft_prompt.parameters())
+        prompt_ids = torch.arange(model.soft_prompt.num_embeddings)
+        input_ids, attention_mask, labels = synthetic_batch(model, batch_size, seq_len)
+        ignore_index = model.gpt2.config.eos_token_id
+        labels[:, :-label_len] = ignore_index
+        batch = (input_ids, attention_mask, labels)
+
+        with SavedTensorMeter(model) as meter:
+            loss = loss_fn(model, prompt_ids, *batch, ignore_index)
+        loss.backward()
+        first_loss = loss.item()
+        optimizer.zero_grad()
+        del loss
+
+        latencies = []
+        for step in range(warmup + steps):
+            start = time.perf_counter()
+            train_step(model, optimizer, prompt_ids, *batch, ignore_index, loss_fn=loss_fn)
+            if step >= warmup:
+                latencies.append((time.perf_counter() - start) * 1000)
+
+        results[mode] = {
+            "loss": round(first_loss, 4),
+            "saved_activations_mb": mb(meter.nbytes),
+            "step_ms_mean": round(sum(latencies) / len(latencies), 2),
+        }
+
+    full, chunked = results["full_logits"], results["chunked"]
+    results["savings"] = {
+        "loss_abs_diff": round(abs(full["loss"] - chunked["loss"]), 4),
+        "memory_mb": round(full["saved_activations_mb"] - chunked["saved_activations_mb"], 2),
+        "step_speedup": round(full["step_ms_mean"] / chunked["step_ms_mean"], 2),
+    }
+    return results
+
+
+def benchmark_selective_head(size, batch_size, seq_len, label_len, repeats):
+    # Evaluation step with the full [B, P + T, V] logits vs hidden states + the LM head on the
+    # labelled positions only (lm_loss, lm_argmax), as in the task scripts' eval loops
+    model = build_model(size).eval()
+    prompt_ids = torch.arange(model.soft_prompt.num_embeddings)
+    input_ids, attention_mask, labels = synthetic_batch(model, batch_size, seq_len)
+    ignore_index = model.gpt2.config.eos_token_id
+    labels[:, :-label_len] = ignore_index
+    positions = labels != ignore_index
+
+    def full_logits():
+        logits = model(input_ids, prompt_ids, attention_mask=attention_mask).logits
+        loss = CrossEntropyLoss(ignore_index=ignore_index)(logits.flatten(0, 1), labels.flatten())
+        return loss, logits.argmax(dim=-1)
+
+    def selective():
+        hidden_states = model.hidden_states(input_ids, prompt_ids, attention_mask=attention_mask)
+        loss = model.lm_loss(hidden_states, labels, ignore_index=ignore_index)
+        return loss, model.lm_argmax(hidden_states, positions=positions, fill_value=ignore_index)
+
+    results = {}
+    predictions = {}
+    with torch.no_grad():
+        for mode, step in [("full_logits", full_logits), ("selective", selective)]:
+            loss, predictions[mode] = step()
+            latencies = []
+            for _ in range(repeats):
+                start = time.perf_counter()
+                step()
+                latencies.append((time.perf_counter() - start) * 1000)
+            results[mode] = {"loss": round(loss.item(), 4), "eval_ms_p50": round(percentile(latencies, 50), 2)}
+
+    vocab_size = model.gpt2.config.vocab_size
+    results["full_logits"]["logits_mb"] = mb(positions.numel() * vocab_size * 4)
+    results["selective"]["logits_mb"] = mb(min(int(positions.sum()), LM_HEAD_CHUNK_SIZE) * min(vocab_size, LM_HEAD_VOCAB_CHUNK_SIZE) * 4)
+    agreement = (predictions["full_logits"][positions] == predictions["selective"][positions]).float().mean()
+    results["comparison"] = {
+        "loss_abs_diff": round(abs(results["full_logits"]["loss"] - results["selective"]["loss"]), 4),
+        "argmax_agreement": round(100 * agreement.item(), 2),
+        "eval_speedup": round(results["full_logits"]["eval_ms_p50"] / results["selective"]["eval_ms_p50"], 2),
+    }
+    return results
+
+
+def checkpointing_run(size, batch_size, seq_len, steps, warmup, gradient_checkpointing):
+    model = build_model(size, gradient_checkpointing=gradient_checkpointing)
+    model.train()
+    optimizer = torch.optim.Adam(model.soft_prompt.parameters())
+    prompt_ids = torch.arange(model.soft_prompt.num_embeddings)
+    batch = synthetic_batch(model, batch_size, seq_len)
+    model_rss = peak_rss_mb()
+
+    with SavedTensorMeter(model) as meter:
+        loss = chunked_loss(model, prompt_ids, *batch)
+    loss.backward()
+    optimizer.zero_grad()
+    del loss
+
+    latencies = []
+    for step in range(warmup + steps):
+        start = time.perf_counter()
+        train_step(model, optimizer, prompt_ids, *batch, loss_fn=chunked_loss)
+        if step >= warmup:
+            latencies.append((time.perf_counter() - start) * 1000)
+
+    step_ms = sum(latencies) / len(latencies)
+    return {
+        "saved_activations_mb": mb(meter.nbytes),
+        "peak_rss_mb": peak_rss_mb(),
+        "training_rss_mb": round(peak_rss_mb() - model_rss, 2),
+        "step_ms_mean": round(step_ms, 2),
+        "train_tokens_per_s": round(batch_size * seq_len / step_ms * 1000, 1),
+    }
+
+
+def benchmark_checkpointing(size, batch_size, seq_len, steps, warmup):
+    # Frozen-backbone prompt training with and without recomputing the GPT-2 blocks in backward.
+    # Each mode runs in its own process so the peak RSS numbers are independent.
+    results = {}
+    for mode, enabled in [("stored_activations", False), ("gradient_checkpointing", True)]:
+        results[mode] = in_fresh_process(checkpointing_run, size, batch_size, seq_len, steps, warmup, enabled)
+
+    stored, recomputed = results["stored_activations"], results["gradient_checkpointing"]
+    results["comparison"] = {
+        "saved_activations_ratio": round(stored["saved_activations_mb"] / recomputed["saved_activations_mb"], 2),
+        "training_rss_saved_mb": round(stored["training_rss_mb"] - recomputed["training_rss_mb"], 2),
+        "throughput_ratio": round(recomputed["train_tokens_per_s"] / stored["train_tokens_per_s"], 2),
+    }
+    return results
+
+
+def accumulation_run(size, batch_size, seq_len, accumulation_steps, per_step_backward):
+    # One optimizer step over accumulation_steps micro-batches, either keeping every micro-step
+    # graph for a single backward (the old loop) or backpropagating each micro-step at once
+    model = build_model(size)
+    model.train()
+    optimizer = torch.optim.Adam(model.soft_prompt.parameters())
+    prompt_ids = torch.arange(model.soft_prompt.num_embeddings)
+    batches = [synthetic_batch(model, batch_size, seq_len, seed=seed) for seed in range(accumulation_steps)]
+    model_rss = peak_rss_mb()
+
+    start = time.perf_counter()
+    loss, tokens = 0, 0
+    for input_ids, attention_mask, labels in batches:
+        hidden_states = model.hidden_states(input_ids, prompt_ids, attention_mask=attention_mask)
+        if per_step_backward:
+            model.lm_loss(hidden_states, labels, reduction="sum").backward()
+            tokens += labels.numel()
+        else:
+            loss += model.lm_loss(hidden_states, labels)
+    if per_step_backward:
+        model.soft_prompt.weight.grad.div_(tokens)
+    else:
+        (loss / accumulation_steps).backward()
+    optimizer.step()
+    return {"training_rss_mb": round(peak_rss_mb() - model_rss, 2), "step_ms": round((time.perf_counter() - start) * 1000, 2)}
+
+
+def benchmark_accumulation(size, batch_size, seq_len, accumulation_steps):
+    # Peak memory of one accumulated optimizer step as the number of micro-steps grows, each
+    # run in a fresh process
+    results = {}
+    for mode, per_step_backward in [("single_backward", False), ("per_step_backward", True)]:
+        results[mode] = {steps: in_fresh_process(accumulation_run, size, batch_size, seq_len, steps, per_step_backward) for steps in accumulation_steps}
+    return results
+
+
+def compiled_run(size, batch_size, buckets, repeats, cache_dir):
+    # Hidden-state latency of eager (prefix-cached) inference vs the exported and the compiled
+    # graphs for inputs filling each bucket, plus how long each engine's warm-up took
+    set_inductor_cache_dir(cache_dir)
+    model = build_model(size).eval()
+    prompt_ids = torch.arange(model.soft_prompt.num_embeddings)
+    engines = {
+        "exported": CompiledSoftPrompt(model, prompt_ids, cache_dir=cache_dir, buckets=buckets, compile=False),
+        "compiled": CompiledSoftPrompt(model, prompt_ids, cache_dir=cache_dir, buckets=buckets, compile=True),
+    }
+    results = {"warmup_s": {mode: round_floats(engine.warmup((batch_size,))) for mode, engine in engines.items()}}
+
+    runners = {"eager": lambda input_ids: model(input_ids, prompt_ids, positions=None).hidden_states}
+    runners.update({mode: engine.hidden_states for mode, engine in engines.items()})
+    with torch.no_grad():
+        for bucket in engines["compiled"].buckets:
+            input_ids, _, _ = synthetic_batch(model, batch_size, bucket - len(prompt_ids))
+            reference = runners["eager"](input_ids)
+            latencies = {}
+            for mode, run in runners.items():
+                max_abs_diff = (run(input_ids) - reference).abs().max().item()
+                timings = []
+                for _ in range(repeats):
+                    start = time.perf_counter()
+                    run(input_ids)
+                    timings.append((time.perf_counter() - start) * 1000)
+                latencies[mode] = {"ms_p50": round(percentile(timings, 50), 2), "max_abs_diff": max_abs_diff}
+            latencies["compiled_speedup"] = round(latencies["eager"]["ms_p50"] / latencies["compiled"]["ms_p50"], 2)
+            results[f"{batch_size}x{bucket}"] = latencies
+    return results
+
+
+def benchmark_compiled(size, batch_size, buckets, repeats, cache_dir=None):
+    # The same run in two fresh processes sharing one cache directory: the first exports and
+    # compiles every bucket, the second loads the graphs and kernels from disk
+    cache_dir = cache_dir or tempfile.mkdtemp(prefix="compiled_cache_")
+    return {
+        "cache_dir": cache_dir,
+        "cold_start": in_fresh_process(compiled_run, size, batch_size, buckets, repeats, cache_dir),
+        "warm_start": in_fresh_process(compiled_run, size, batch_size, buckets, repeats, cache_dir),
+    }
+
+
+def latency_stats(latencies):
+    return {
+        "ms_mean": round(sum(latencies) / len(latencies), 2),
+        "ms_p50": round(percentile(latencies, 50), 2),
+        "ms_p90": round(percentile(latencies, 90), 2),
+        "ms_p99": round(percentile(latencies, 99), 2),
+    }
+
+
+def task_batch(model, task, batch_size, seed=0):
+    # Full-length inputs with the task's number of real labels at the start of each label row,
+    # as SoftPromptCollator lays them out, and eos padding after them
+    shape = TASK_SHAPES[task]
+    input_ids, attention_mask, labels = synthetic_batch(model, batch_size, shape["seq_len"] - model.soft_prompt.num_embeddings, seed=seed)
+    labels[:, shape["label_len"]:] = model.gpt2.config.eos_token_id
+    return input_ids, attention_mask, labels
+
+
+def suite_run(size, task, phase, batch_size, steps, warmup, precision):
+    # One task and phase the way the scripts run it: a training step (chunked loss, backward,
+    # clipping, optimizer), an evaluation batch (loss and argmax on labelled positions) or a
+    # greedy generate() call of new_tokens tokens
+    model = build_model(size, precision=precision)
+    prompt_ids = torch.arange(model.soft_prompt.num_embeddings)
+    ignore_index = model.gpt2.config.eos_token_id
+    shape = TASK_SHAPES[task]
+    input_ids, attention_mask, labels = task_batch(model, task, batch_size)
+
+    if phase == "train":
+        model.train()
+        optimizer = torch.optim.Adam(model.soft_prompt.parameters())
+        tokens_per_step = batch_size * shape["seq_len"]
+
+        def step():
+            train_step(model, optimizer, prompt_ids, input_ids, attention_mask, labels, ignore_index, loss_fn=chunked_loss)
+    elif phase == "eval":
+        model.eval()
+        tokens_per_step = batch_size * shape["seq_len"]
+
+        def step():
+            with torch.no_grad():
+                hidden_states = model.hidden_states(input_ids, prompt_ids, attention_mask=attention_mask)
+                model.lm_loss(hidden_states, labels, ignore_index=ignore_index)
+                model.lm_argmax(hidden_states, positions=labels != ignore_index, fill_value=ignore_index)
+    else:
+        model.eval()
+        tokens_per_step = batch_size * shape["new_tokens"]
+        prompt_input = input_ids[:, :shape["seq_len"] - len(prompt_ids) - shape["new_tokens"]]
+
+        def step():
+            model.generate(prompt_input, prompt_ids, max_new_tokens=shape["new_tokens"])
+
+    latencies = []
+    for index in range(warmup + steps):
+        start = time.perf_counter()
+        step()
+        if index >= warmup:
+            latencies.append((time.perf_counter() - start) * 1000)
+
+    stats = latency_stats(latencies)
+    return {"tokens_per_s": round(tokens_per_step / stats["ms_mean"] * 1000, 1), **stats, "peak_rss_mb": peak_rss_mb()}
+
+
+def compare_suites(baseline, current):
+    # current / baseline for every task and phase both runs have; tokens_per_s below 1 and
+    # latency or memory above 1 are regressions
+    regression = {}
+    for task, phases in current.items():
+        for phase, result in phases.items():
+            reference = baseline.get(task, {}).get(phase)
+            if reference:
+                regression.setdefault(task, {})[phase] = {
+                    f"{metric}_ratio": round(result[metric] / reference[metric], 3) for metric in ("tokens_per_s", "ms_p50", "ms_p99", "peak_rss_mb")
+                }
+    return regression
+
+
+def benchmark_suite(size, tasks, phases, batch_size, steps, warmup, precision, baseline=None):
+    # Every task and phase in a fresh process, so each peak RSS is its own
+    results = {
+        "config": {"size": size, "batch_size": batch_size, "steps": steps, "warmup": warmup, "precision": precision, "task_shapes": {task: TASK_SHAPES[task] for task in tasks}},
+        "environment": {"torch": torch.__version__, "cpu_capability": torch.backends.cpu.get_cpu_capability(), "threads": torch.get_num_threads()},
+        "tasks": {task: {phase: in_fresh_process(suite_run, size, task, phase, batch_size, steps, warmup, precision) for phase in phases} for task in tasks},
+    }
+    if baseline:
+        with open(baseline) as file:
+            results["regression"] = compare_suites(json.load(file)["tasks"], results["tasks"])
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmarks for GPT2WithSoftPrompt")
+    parser.add_argument("--size", choices=sorted(BACKBONE_CONFIGS), default="tiny")
+    parser.add_argument("--output", help="Also write the results to this JSON file")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    frozen = subparsers.add_parser("frozen-backbone", help="Trainable vs frozen GPT-2 backbone training step")
+    frozen.add_argument("--batch-size", type=int, default=1)
+    frozen.add_argument("--seq-len", type=int, default=1023)
+    frozen.add_argument("--steps", type=int, default=5)
+    frozen.add_argument("--warmup", type=int, default=1)
+
+    precision = subparsers.add_parser("precision", help="fp32 vs bf16 autocast: loss/overlap parity and speed")
+    precision.add_argument("--batch-size", type=int, default=4)
+    precision.add_argument("--seq-len", type=int, default=256)
+    precision.add_argument("--steps", type=int, default=5)
+    precision.add_argument("--warmup", type=int, default=1)
+
+    quantized = subparsers.add_parser("quantized", help="fp32 vs dynamic int8 backbone: parity, weight size and speed")
+    quantized.add_argument("--batch-size", type=int, default=4)
+    quantized.add_argument("--seq-len", type=int, default=256)
+    quantized.add_argument("--batches", type=int, default=4)
+
+    chunked = subparsers.add_parser("chunked-loss", help="Full-logits vs chunked LM head loss: activation memory and speed")
+    chunked.add_argument("--batch-size", type=int, default=1)
+    chunked.add_argument("--seq-len", type=int, default=1023)
+    chunked.add_argument("--label-len", type=int, default=128)
+    chunked.add_argument("--steps", type=int, default=3)
+    chunked.add_argument("--warmup", type=int, default=1)
+
+    selective = subparsers.add_parser("selective-head", help="Full logits vs LM head on labelled positions only in evaluation")
+    selective.add_argument("--batch-size", type=int, default=4)
+    selective.add_argument("--seq-len", type=int, default=1023)
+    selective.add_argument("--label-len", type=int, default=128)
+    selective.add_argument("--repeats", type=int, default=3)
+
+    checkpointing = subparsers.add_parser("checkpointing", help="Stored vs recomputed GPT-2 activations in prompt training: memory and throughput")
+    checkpointing.add_argument("--batch-size", type=int, default=4)
+    checkpointing.add_argument("--seq-len", type=int, default=1023)
+    checkpointing.add_argument("--steps", type=int, default=3)
+    checkpointing.add_argument("--warmup", type=int, default=1)
+
+    accumulation = subparsers.add_parser("accumulation", help="Gradient accumulation with one backward vs a backward per micro-step: peak memory")
+    accumulation.add_argument("--batch-size", type=int, default=1)
+    accumulation.add_argument("--seq-len", type=int, default=1023)
+    accumulation.add_argument("--accumulation-steps", type=int, nargs="+", default=[1, 2, 4, 8])
+
+    compiled = subparsers.add_parser("compiled", help="Eager vs exported vs torch.compile inference latency per shape bucket, cold and cached")
+    compiled.add_argument("--batch-size", type=int, default=1)
+    compiled.add_argument("--buckets", type=int, nargs="+", default=list(INFERENCE_BUCKETS))
+    compiled.add_argument("--repeats", type=int, default=5)
+    compiled.add_argument("--cache-dir", help="Graph/kernel cache directory (default: a new temporary one)")
+
+    suite = subparsers.add_parser("suite", help="Train/eval/generation throughput, latency percentiles and peak RSS on task-shaped synthetic data")
+    suite.add_argument("--tasks", nargs="+", choices=sorted(TASK_SHAPES), default=list(TASK_SHAPES))
+    suite.add_argument("--phases", nargs="+", choices=SUITE_PHASES, default=list(SUITE_PHASES))
+    suite.add_argument("--batch-size", type=int, default=1)
+    suite.add_argument("--steps", type=int, default=5)
+    suite.add_argument("--warmup", type=int, default=1)
+    suite.add_argument("--precision", choices=["fp32", "bf16"], default="fp32")
+    suite.add_argument("--baseline", help="Earlier suite --output JSON to compare against")
+
+    args = parser.parse_args()
+
+    if args.benchmark == "frozen-backbone":
+        results = benchmark_frozen_backbone(args.size, args.batch_size, args.seq_len, args.steps, args.warmup)
+    elif args.benchmark == "precision":
+        results = benchmark_precision(args.size, args.batch_size, args.seq_len, args.steps, args.warmup)
+    elif args.benchmark == "quantized":
+        results = benchmark_quantized(args.size, args.batch_size, args.seq_len, args.batches)
+    elif args.benchmark == "chunked-loss":
+        results = benchmark_chunked_loss(args.size, args.batch_size, args.seq_len, args.label_len, args.steps, args.warmup)
+    elif args.benchmark == "selective-head":
+        results = benchmark_selective_head(args.size, args.batch_size, args.seq_len, args.label_len, args.repeats)
+    elif args.benchmark == "checkpointing":
+        results = benchmark_checkpointing(args.size, args.batch_size, args.seq_len, args.steps, args.warmup)
+    elif args.benchmark == "accumulation":
+        results = benchmark_accumulation(args.size, args.batch_size, args.seq_len, args.accumulation_steps)
+    elif args.benchmark == "compiled":
+        results = benchmark_compiled(args.size, args.batch_size, args.buckets, args.repeats, args.cache_dir)
+    elif args.benchmark == "suite":
+        results = benchmark_suite(args.size, args.tasks, args.phases, args.batch_size, args.steps, args.warmup, args.precision, args.baseline)
+
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,558 @@
+import functools
+import hashlib
+import itertools
+import json
+import os
+import random
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import torch
+from torch.utils.data import DataLoader, Dataset, Sampler
+from transformers import GPT2TokenizerFast
+
+
+# Tokenization
+@functools.lru_cache(maxsize=None)
+def get_tokenizer(model_name):
+    # One fast (Rust) tokenizer per process instead of a new slow one per call
+    return GPT2TokenizerFast.from_pretrained(model_name)
+
+
+def encode_chunk(tokenizer, texts, max_length):
+    # Same ids as tokenizer.encode(text, truncation=True, max_length=max_length) row by row
+    if not texts:
+        return []
+    if max_length is None:
+        return tokenizer(texts)["input_ids"]
+    return tokenizer(texts, truncation=True, max_length=max_length)["input_ids"]
+
+
+def init_tokenizer_worker(model_name):
+    # Workers tokenize their chunk sequentially; the pool provides the parallelism
+    os.environ["TOKENIZERS_PARALLELISM"] = "false"
+    get_tokenizer(model_name)
+
+
+def encode_chunk_in_worker(model_name, texts, max_length):
+    return encode_chunk(get_tokenizer(model_name), texts, max_length)
+
+
+def batch_encode(texts, model_name, max_length=None, num_workers=0, chunk_size=2048):
+    # Tokenizes a whole column in batches. With num_workers > 1 the chunks are spread over a
+    # process pool, which pays off for full-size corpora such as CNN/DailyMail.
+    texts = list(texts)
+    if num_workers <= 1 or len(texts) <= chunk_size:
+        return encode_chunk(get_tokenizer(model_name), texts, max_length)
+
+    chunks = [texts[i:i + chunk_size] for i in range(0, len(texts), chunk_size)]
+    with ProcessPoolExecutor(num_workers, initializer=init_tokenizer_worker, initargs=(model_name,)) as pool:
+        encoded = pool.map(encode_chunk_in_worker, [model_name] * len(chunks), chunks, [max_length] * len(chunks))
+        return [ids for chunk in encoded for ids in chunk]
+
+
+# Streaming CSV
+def stream_csv(file_path, columns, chunk_size=10000):
+    # Reads a large CSV chunk by chunk, never materializing the whole DataFrame
+    for chunk in pd.read_csv(file_path, usecols=columns, chunksize=chunk_size):
+        yield chunk.dropna()
+
+
+def sample_csv(file_path, columns, frac=None, num_rows=None, seed=0, chunk_size=10000):
+    # Seeded sample from a chunked read. frac keeps each row independently with that probability
+    # (Bernoulli), num_rows keeps exactly that many rows (reservoir sampling). Memory grows with
+    # the sample, not with the file.
+    rng = np.random.default_rng(seed)
+    if num_rows is None:
+        kept = [chunk[rng.random(len(chunk)) < frac] for chunk in stream_csv(file_path, columns, chunk_size)]
+        return pd.concat(kept, ignore_index=True) if kept else pd.DataFrame(columns=columns)
+
+    reservoir = []
+    seen = 0
+    for chunk in stream_csv(file_path, columns, chunk_size):
+        for row in chunk.itertuples(index=False):
+            if seen < num_rows:
+                reservoir.append(row)
+            else:
+                slot = rng.integers(0, seen + 1)
+                if slot < num_rows:
+                    reservoir[slot] = row
+            seen += 1
+    return pd.DataFrame(reservoir, columns=columns)
+
+
+# Streaming JSON
+def iter_json_array(file_path, key, chunk_size=1 << 20):
+    # Yields the elements of the top-level array stored under key one at a time, decoding from
+    # a small rolling buffer, so only one element (e.g. one SQuAD article) is in memory at once.
+    # Assumes key appears before any other occurrence of the same quoted string, as in SQuAD.
+    decoder = json.JSONDecoder()
+    with open(file_path, "r", encoding="utf-8") as file:
+        buffer = ""
+        position = -1
+        while position < 0:
+            chunk = file.read(chunk_size)
+            if not chunk:
+                raise ValueError(f"{file_path}: no {key!r} array found")
+            buffer += chunk
+            position = buffer.find(f'"{key}"')
+        buffer = buffer[position + len(key) + 2:]
+
+        expected = ":["
+        while True:
+            buffer = buffer.lstrip()
+            if not buffer:
+                chunk = file.read(chunk_size)
+                if not chunk:
+                    raise ValueError(f"{file_path}: truncated JSON")
+                buffer = chunk
+                continue
+            if expected:
+                if buffer[0] != expected[0]:
+                    raise ValueError(f"{file_path}: expected {expected[0]!r} after {key!r}")
+                buffer = buffer[1:]
+                expected = expected[1:]
+                continue
+            if buffer[0] == "]":
+                return
+            if buffer[0] == ",":
+                buffer = buffer[1:]
+                continue
+            try:
+                item, end = decoder.raw_decode(buffer)
+            except json.JSONDecodeError:
+                # The element runs past the buffer, read more of it
+                chunk = file.read(chunk_size)
+                if not chunk:
+                    raise
+                buffer += chunk
+                continue
+            if end == len(buffer):
+                # A number ending at the buffer end may continue in the next chunk, decode it again
+                chunk = file.read(chunk_size)
+                if chunk:
+                    buffer += chunk
+                    continue
+            yield item
+            buffer = buffer[end:]
+
+
+def iter_squad(file_path):
+    # Yields (context, [(question, answer), ...]) for every SQuAD paragraph, keeping every
+    # answerable question. Unanswerable SQuAD 2.0 questions are dropped: an empty answer has no
+    # label tokens, so it has no loss to train on and nothing to score. Paragraphs left without
+    # questions are skipped.
+    for article in iter_json_array(file_path, "data"):
+        for paragraph in article["paragraphs"]:
+            qas = [(qa["question"], qa["answers"][0]["text"]) for qa in paragraph["qas"] if qa["answers"]]
+            if qas:
+                yield paragraph["context"], qas
+
+
+class ContextQuestionColumn:
+    # Input column for SQuAD style data: row i is question i followed by its paragraph's context.
+    # The question comes first because the answer labels sit at the first output positions and
+    # attention is causal, so those positions can only see the start of the row. Each context is
+    # tokenized and stored once and shared by all of its questions; rows are assembled on access,
+    # dropping the end of the context when a row exceeds max_length.
+    def __init__(self, contexts, questions, context_index, max_length):
+        self.contexts = contexts
+        self.questions = questions
+        self.context_index = context_index
+        self.max_length = max_length
+
+    def __len__(self):
+        return len(self.questions)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        question = np.asarray(self.questions[index], dtype=np.int64)[:self.max_length]
+        context = np.asarray(self.contexts[self.context_index[index]], dtype=np.int64)
+        return np.concatenate([question, context[:self.max_length - len(question)]])
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def lengths(self):
+        context_lengths = sequence_lengths(self.contexts)[self.context_index]
+        question_lengths = np.minimum(sequence_lengths(self.questions), self.max_length)
+        return np.minimum(context_lengths + question_lengths, self.max_length)
+
+
+def context_question_column(contexts, questions, question_counts, max_length):
+    # question_counts holds one [count] row per paragraph, in the order the questions were written
+    counts = np.array([int(count[0]) for count in question_counts], dtype=np.int64)
+    context_index = np.repeat(np.arange(len(counts)), counts)
+    return ContextQuestionColumn(contexts, questions, context_index, max_length)
+
+
+def sequence_lengths(column):
+    if isinstance(column, TokenColumn):
+        return np.diff(column.offsets)
+    return np.array([len(tokens) for tokens in column], dtype=np.int64)
+
+
+# Line-indexed Corpora
+LINE_INDEX_VERSION = 1
+
+
+def build_line_offsets(path, block_size=1 << 24):
+    # Start byte of every line plus the file size, from one binary pass over the file
+    starts = [np.zeros(1, dtype=np.int64)]
+    position = 0
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(block_size), b""):
+            newlines = np.flatnonzero(np.frombuffer(block, dtype=np.uint8) == ord("\n"))
+            starts.append(position + newlines + 1)
+            position += len(block)
+    offsets = np.concatenate(starts)
+    if offsets[-1] != position:
+        # Last line without a trailing newline
+        offsets = np.append(offsets, position)
+    return offsets
+
+
+def line_offsets(path, cache_dir=None):
+    # Byte offsets of every line of path, persisted in cache_dir next to the token cache and
+    # rebuilt when the file's size or mtime changes. Row i spans offsets[i]:offsets[i + 1].
+    if cache_dir is None:
+        return build_line_offsets(path)
+
+    stat = os.stat(path)
+    identity = {"version": LINE_INDEX_VERSION, "path": os.path.abspath(path), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+    name = os.path.basename(path) + "-" + hashlib.sha256(os.path.abspath(path).encode("utf-8")).hexdigest()[:8]
+    index_path = os.path.join(cache_dir, name + ".lines.npy")
+    meta_path = os.path.join(cache_dir, name + ".lines.json")
+    if os.path.exists(meta_path) and os.path.exists(index_path):
+        with open(meta_path) as file:
+            if json.load(file) == identity:
+                return np.load(index_path, mmap_mode="r")
+
+    os.makedirs(cache_dir, exist_ok=True)
+    offsets = build_line_offsets(path)
+    np.save(index_path, offsets)
+    with open(meta_path, "w") as file:
+        json.dump(identity, file, indent=2)
+    return offsets
+
+
+class ParallelCorpus:
+    # Line-aligned pair of text files (e.g. europarl-v7.de-en.en / .de) read lazily through their
+    # line offsets, so a range or sample of pairs costs a few seeks rather than reading the
+    # corpus. Lines keep their newline, exactly as readlines() returns them.
+    def __init__(self, source_path, target_path, cache_dir=None, start=0, stop=None, offsets=None):
+        self.paths = (source_path, target_path)
+        if offsets is None:
+            offsets = tuple(line_offsets(path, cache_dir) for path in self.paths)
+            if len(offsets[0]) != len(offsets[1]):
+                raise ValueError(f"{source_path} has {len(offsets[0]) - 1} lines but {target_path} has {len(offsets[1]) - 1}")
+        self.offsets = offsets
+        self.start = start
+        self.stop = len(offsets[0]) - 1 if stop is None else stop
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def shard(self, shard_index, num_shards):
+        # Contiguous 1/num_shards of this corpus, e.g. one per DataLoader or tokenizer worker
+        bounds = np.linspace(self.start, self.stop, num_shards + 1).astype(np.int64)
+        return ParallelCorpus(*self.paths, start=int(bounds[shard_index]), stop=int(bounds[shard_index + 1]), offsets=self.offsets)
+
+    def read(self, start=0, stop=None):
+        # Pairs start:stop of this corpus, one seek and one read per file
+        stop = len(self) if stop is None else min(stop, len(self))
+        start, stop = self.start + start, self.start + max(start, stop)
+        columns = []
+        for path, offsets in zip(self.paths, self.offsets):
+            with open(path, "rb") as file:
+                file.seek(offsets[start])
+                block = file.read(int(offsets[stop] - offsets[start]))
+            bounds = np.asarray(offsets[start:stop + 1]) - offsets[start]
+            columns.append([block[a:b].decode("utf-8") for a, b in zip(bounds[:-1], bounds[1:])])
+        return tuple(columns)
+
+    def sample(self, num_pairs, seed=0):
+        # Seeded random pairs without replacement, read in file order with one seek per line
+        rng = np.random.default_rng(seed)
+        indices = np.sort(rng.choice(len(self), size=min(num_pairs, len(self)), replace=False)) + self.start
+        columns = []
+        for path, offsets in zip(self.paths, self.offsets):
+            with open(path, "rb") as file:
+                column = []
+                for index in indices:
+                    file.seek(offsets[index])
+                    column.append(file.read(int(offsets[index + 1] - offsets[index])).decode("utf-8"))
+            columns.append(column)
+        return tuple(columns)
+
+
+# Token Cache
+TOKEN_CACHE_VERSION = 2
+
+
+class TokenColumn:
+    # Read-only list of token sequences stored as one flat token array plus an offsets index,
+    # usually memory-mapped from the token cache. Contiguous slices are views, not copies.
+    def __init__(self, tokens, offsets):
+        self.tokens = tokens
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step == 1:
+                return TokenColumn(self.tokens, self.offsets[start:max(start, stop) + 1])
+            return [self[i] for i in range(start, stop, step)]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        return self.tokens[self.offsets[index]:self.offsets[index + 1]].astype(np.int64)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+
+def file_hash(path, cache_dir):
+    # sha256 of a source file, remembered per (size, mtime) so unchanged gigabyte corpora are
+    # not re-read on every run
+    memo_path = os.path.join(cache_dir, "file_hashes.json")
+    memo = {}
+    if os.path.exists(memo_path):
+        with open(memo_path) as file:
+            memo = json.load(file)
+
+    stat = os.stat(path)
+    entry = memo.get(os.path.abspath(path))
+    if entry and entry["size"] == stat.st_size and entry["mtime_ns"] == stat.st_mtime_ns:
+        return entry["sha256"]
+
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(1 << 20), b""):
+            digest.update(block)
+    memo[os.path.abspath(path)] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": digest.hexdigest()}
+    # Written to a temporary file first so a concurrent run never reads a half-written memo
+    tmp_path = f"{memo_path}.tmp-{os.getpid()}"
+    with open(tmp_path, "w") as file:
+        json.dump(memo, file, indent=2)
+    os.replace(tmp_path, memo_path)
+    return digest.hexdigest()
+
+
+@functools.lru_cache(maxsize=None)
+def tokenizer_fingerprint(model_name):
+    # Hash of the full tokenizer definition (vocab, merges, normalization), not just its name
+    serialized = get_tokenizer(model_name).backend_tokenizer.to_str()
+    return hashlib.sha256(serialized.encode("utf-8")).hexdigest()[:16]
+
+
+def as_chunks(columns):
+    # build() functions return either one tuple of columns or an iterator of such tuples
+    return [columns] if isinstance(columns, tuple) else columns
+
+
+def write_token_columns(path, chunks, metadata, dtype):
+    # Tokens are appended chunk by chunk, so a full-size corpus never has to be held in memory.
+    # Written to a temporary directory first so an interrupted run never leaves a half cache.
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+
+    token_files = []
+    offsets = []
+    ends = []
+    for chunk in as_chunks(chunks):
+        if not token_files:
+            token_files = [open(os.path.join(tmp_path, f"column{index}.tokens.bin"), "wb") for index in range(len(chunk))]
+            offsets = [[np.zeros(1, dtype=np.int64)] for _ in chunk]
+            ends = [0] * len(chunk)
+        for index, column in enumerate(chunk):
+            lengths = np.fromiter((len(tokens) for tokens in column), dtype=np.int64, count=len(column))
+            tokens = np.fromiter(itertools.chain.from_iterable(column), dtype=np.int64, count=int(lengths.sum()))
+            token_files[index].write(tokens.astype(dtype).tobytes())
+            offsets[index].append(ends[index] + np.cumsum(lengths))
+            ends[index] += int(lengths.sum())
+
+    for index, file in enumerate(token_files):
+        file.close()
+        np.save(os.path.join(tmp_path, f"column{index}.offsets.npy"), np.concatenate(offsets[index]))
+    with open(os.path.join(tmp_path, "meta.json"), "w") as file:
+        json.dump(dict(metadata, num_columns=len(token_files), dtype=np.dtype(dtype).name), file, indent=2)
+
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp_path, path)
+
+
+def load_token_columns(path, key):
+    # Returns None when the cache is missing or was built from other sources/settings
+    meta_path = os.path.join(path, "meta.json")
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path) as file:
+        metadata = json.load(file)
+    if metadata.get("key") != key:
+        return None
+
+    columns = []
+    for index in range(metadata["num_columns"]):
+        offsets = np.load(os.path.join(path, f"column{index}.offsets.npy"), mmap_mode="r")
+        if offsets[-1] == 0:
+            tokens = np.zeros(0, dtype=metadata["dtype"])
+        else:
+            tokens = np.memmap(os.path.join(path, f"column{index}.tokens.bin"), dtype=metadata["dtype"], mode="r", shape=(int(offsets[-1]),))
+        columns.append(TokenColumn(tokens, offsets))
+    return tuple(columns)
+
+
+def concat_chunks(chunks):
+    columns = None
+    for chunk in as_chunks(chunks):
+        if columns is None:
+            columns = tuple([] for _ in chunk)
+        for column, part in zip(columns, chunk):
+            column.extend(part)
+    return columns
+
+
+def cached_tokenize(cache_dir, name, source_files, model_name, settings, build):
+    # Returns build()'s tuple of token columns, from cache_dir/name when its key still matches.
+    # build() may also yield the columns chunk by chunk. The key covers the source file contents,
+    # the tokenizer definition and every setting that changes the ids (MAX_LEN, truncation
+    # lengths, sampling); a mismatch rebuilds the cache.
+    if cache_dir is None:
+        return concat_chunks(build())
+    os.makedirs(cache_dir, exist_ok=True)
+    identity = {
+        "version": TOKEN_CACHE_VERSION,
+        "sources": [file_hash(path, cache_dir) for path in source_files],
+        "tokenizer": tokenizer_fingerprint(model_name),
+        "settings": settings,
+    }
+    key = hashlib.sha256(json.dumps(identity, sort_keys=True).encode("utf-8")).hexdigest()
+
+    # One directory per name and settings; new source contents or tokenizer replace it in place
+    settings_hash = hashlib.sha256(json.dumps(settings, sort_keys=True).encode("utf-8")).hexdigest()[:8]
+    path = os.path.join(cache_dir, f"{name}-{settings_hash}")
+    columns = load_token_columns(path, key)
+    if columns is None:
+        dtype = np.uint16 if len(get_tokenizer(model_name)) <= 2 ** 16 else np.uint32
+        write_token_columns(path, build(), dict(identity, key=key, source_files=list(source_files), model_name=model_name), dtype)
+        columns = load_token_columns(path, key)
+    return columns
+
+
+# Dynamic Padding
+class SoftPromptCollator:
+    # Pads a list of (input_tokens, label_tokens) pairs to the longest row in the batch.
+    # Labels are aligned with the model output, which starts with num_prompts soft prompt
+    # positions, so a row's labels may run up to num_prompts tokens past its input.
+    def __init__(self, pad_token_id, num_prompts, pad_to_multiple_of=None):
+        self.pad_token_id = pad_token_id
+        self.num_prompts = num_prompts
+        self.pad_to_multiple_of = pad_to_multiple_of
+
+    def __call__(self, batch):
+        lengths = [example_length(inputs, labels, self.num_prompts) for inputs, labels in batch]
+        seq_len = max(lengths)
+        if self.pad_to_multiple_of:
+            seq_len = -(-seq_len // self.pad_to_multiple_of) * self.pad_to_multiple_of
+
+        input_ids = torch.full((len(batch), seq_len), self.pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(batch), seq_len), dtype=torch.long)
+        labels = torch.full((len(batch), self.num_prompts + seq_len), self.pad_token_id, dtype=torch.long)
+
+        for row, ((inputs, targets), length) in enumerate(zip(batch, lengths)):
+            input_ids[row, :len(inputs)] = torch.tensor(inputs, dtype=torch.long)
+            # Filler up to the end of the labels stays visible, exactly as with fixed MAX_LEN
+            # padding, so the loss is unchanged; only the batch tail is masked out
+            attention_mask[row, :length] = 1
+            labels[row, :len(targets)] = torch.tensor(targets, dtype=torch.long)
+
+        return input_ids, attention_mask, labels
+
+
+def example_length(inputs, labels, num_prompts):
+    # Number of input positions a row needs so that every label has an output position
+    return max(len(inputs), len(labels) - num_prompts, 1)
+
+
+# Length Bucketing
+class LengthBucketSampler(Sampler):
+    # Yields batches of indices whose examples have similar lengths, so SoftPromptCollator
+    # pads each batch only a little. Examples are shuffled, sorted by length inside pools
+    # of bucket_size batches, cut into batches and the batch order is shuffled again.
+    def __init__(self, lengths, batch_size, shuffle=True, bucket_size=50, seed=0):
+        self.lengths = list(lengths)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.bucket_size = bucket_size
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        # Reshuffles a long-lived loader (and its persistent workers) for the next epoch
+        self.epoch = epoch
+
+    def __iter__(self):
+        indices = list(range(len(self.lengths)))
+        rng = random.Random(self.seed + self.epoch)
+        if self.shuffle:
+            rng.shuffle(indices)
+            pool_size = self.batch_size * self.bucket_size
+        else:
+            pool_size = len(indices)
+
+        batches = []
+        for start in range(0, len(indices), max(pool_size, 1)):
+            pool = sorted(indices[start:start + pool_size], key=lambda i: self.lengths[i])
+            batches.extend(pool[i:i + self.batch_size] for i in range(0, len(pool), self.batch_size))
+
+        if self.shuffle:
+            rng.shuffle(batches)
+        return iter(batches)
+
+    def __len__(self):
+        return (len(self.lengths) + self.batch_size - 1) // self.batch_size
+
+
+class PairDataset(Dataset):
+    # (input_tokens, label_tokens) pairs read lazily from lists or memory-mapped TokenColumns
+    def __init__(self, inputs, labels):
+        self.inputs = inputs
+        self.labels = labels
+
+    def __len__(self):
+        return min(len(self.inputs), len(self.labels))
+
+    def __getitem__(self, index):
+        return self.inputs[index], self.labels[index]
+
+
+def example_lengths(inputs, labels, num_prompts):
+    if isinstance(inputs, (TokenColumn, ContextQuestionColumn)) and isinstance(labels, TokenColumn):
+        # Straight from the offsets index, without touching the token arrays
+        count = min(len(inputs), len(labels))
+        input_lengths = inputs.lengths()[:count] if isinstance(inputs, ContextQuestionColumn) else np.diff(inputs.offsets[:count + 1])
+        label_lengths = np.diff(labels.offsets[:count + 1]) - num_prompts
+        return np.maximum(np.maximum(input_lengths, label_lengths), 1).tolist()
+    return [example_length(x, y, num_prompts) for x, y in zip(inputs, labels)]
+
+
+def make_dataloader(inputs, labels, batch_size, pad_token_id, num_prompts, shuffle=False, seed=0, num_workers=0, pin_memory=False, prefetch_factor=2):
+    # With num_workers > 0, batches are read and collated by persistent worker processes,
+    # prefetch_factor batches per worker ahead of the model. pin_memory lets the training loop
+    # copy them to the GPU with non_blocking=True, overlapping the copy with compute.
+    lengths = example_lengths(inputs, labels, num_prompts)
+    sampler = LengthBucketSampler(lengths, batch_size, shuffle=shuffle, seed=seed)
+    collator = SoftPromptCollator(pad_token_id, num_prompts)
+    workers = dict(num_workers=num_workers, prefetch_factor=prefetch_factor, persistent_workers=True) if num_workers > 0 else {}
+    return DataLoader(PairDataset(inputs, labels), batch_sampler=sampler, collate_fn=collator, pin_memory=pin_memory, **workers)
@@ -0,0 +1,116 @@
+import argparse
+import json
+import os
+
+import numpy as np
+import torch
+from transformers import GPT2LMHeadModel
+
+from soft_prompt import cache_tensors, load_soft_prompt, read_soft_prompt, to_cache
+
+
+class PromptDecoder(torch.nn.Module):
+    # GPT2WithSoftPrompt for one fixed prompt, shaped for export: the prompt's per-layer
+    # keys/values are constants, so one graph serves both the prefill (no past) and every
+    # decoding step. Past/present keys and values are stacked over layers, [L, B, H, S, D],
+    # and never include the prompt positions.
+    def __init__(self, model, prompt_ids):
+        super().__init__()
+        self.model = model.eval()
+        with torch.no_grad():
+            prefix, _, prompt_logits = model.prompt_prefix(prompt_ids)
+        self.register_buffer("prompt_keys", torch.stack([key for key, _ in prefix]))
+        self.register_buffer("prompt_values", torch.stack([value for _, value in prefix]))
+        self.register_buffer("prompt_logits", prompt_logits[0].clone())
+
+    def forward(self, input_ids, attention_mask, past_keys, past_values):
+        batch_size, num_tokens = input_ids.shape
+        num_prompts = self.prompt_keys.size(3)
+        keys = torch.cat([self.prompt_keys.expand(-1, batch_size, -1, -1, -1), past_keys], dim=3)
+        values = torch.cat([self.prompt_values.expand(-1, batch_size, -1, -1, -1), past_values], dim=3)
+        attention_mask = torch.cat([attention_mask.new_ones(batch_size, num_prompts), attention_mask], dim=1)
+        position_ids = (attention_mask.cumsum(dim=-1) - 1).clamp(min=0)[:, -num_tokens:]
+
+        past_key_values = to_cache(tuple((keys[layer], values[layer]) for layer in range(keys.size(0))))
+        outputs = self.model.run_gpt2(input_ids=input_ids, past_key_values=past_key_values, attention_mask=attention_mask,
+                                      position_ids=position_ids, use_cache=True)
+        present = cache_tensors(outputs.past_key_values)
+        present_keys = torch.stack([key for key, _ in present])[:, :, :, num_prompts:]
+        present_values = torch.stack([value for _, value in present])[:, :, :, num_prompts:]
+        return outputs.logits, present_keys, present_values, self.prompt_logits
+
+
+def export_onnx(model, prompt_ids, path):
+    # Writes the ONNX graph of PromptDecoder with dynamic batch, token and past lengths
+    if model.precision != "fp32":
+        raise ValueError("export an fp32 model; onnxruntime runs the graph in the dtype it was exported in")
+    decoder = PromptDecoder(model, prompt_ids).eval()
+    config = model.gpt2.config
+    head_dim = config.n_embd // config.n_head
+    input_ids = torch.zeros((2, 3), dtype=torch.long)
+    attention_mask = torch.ones((2, 5), dtype=torch.long)
+    past = torch.zeros((config.n_layer, 2, config.n_head, 2, head_dim))
+    dynamic = torch.export.Dim.DYNAMIC
+    dynamic_shapes = {
+        "input_ids": {0: dynamic, 1: dynamic},
+        "attention_mask": {0: dynamic, 1: dynamic},
+        "past_keys": {1: dynamic, 3: dynamic},
+        "past_values": {1: dynamic, 3: dynamic},
+    }
+    with torch.no_grad():
+        torch.onnx.export(decoder, (input_ids, attention_mask, past, past), path, dynamo=True, dynamic_shapes=dynamic_shapes,
+                          input_names=["input_ids", "attention_mask", "past_keys", "past_values"],
+                          output_names=["logits", "present_keys", "present_values", "prompt_logits"])
+
+
+def check_parity(model, prompt_ids, path, batch_size=2, seq_len=16, max_new_tokens=8, seed=0):
+    # Logits of a left-padded random batch and greedy generations, PyTorch vs onnxruntime
+    from onnx_backend import OnnxSoftPrompt
+
+    backend = OnnxSoftPrompt(path)
+    generator = torch.Generator().manual_seed(seed)
+    input_ids = torch.randint(0, model.gpt2.config.vocab_size, (batch_size, seq_len), generator=generator)
+    attention_mask = torch.ones_like(input_ids)
+    attention_mask[0, :seq_len // 4] = 0
+
+    model.eval()
+    with torch.no_grad():
+        logits = model(input_ids, prompt_ids, attention_mask=attention_mask).logits.numpy()
+        generated = model.generate(input_ids, prompt_ids, attention_mask=attention_mask, max_new_tokens=max_new_tokens).numpy()
+    onnx_logits = backend(input_ids.numpy(), attention_mask=attention_mask.numpy()).logits
+    onnx_generated = backend.generate(input_ids.numpy(), attention_mask=attention_mask.numpy(), max_new_tokens=max_new_tokens)
+
+    real = np.concatenate([np.ones((batch_size, len(prompt_ids)), dtype=bool), attention_mask.numpy().astype(bool)], axis=1)
+    return {
+        "logits_max_abs_diff": float(np.abs(logits - onnx_logits)[real].max()),
+        "argmax_agreement": float((logits.argmax(-1) == onnx_logits.argmax(-1))[real].mean() * 100),
+        "greedy_generation_match": bool((generated == onnx_generated).all()),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export a trained soft prompt and its GPT-2 backbone to ONNX")
+    parser.add_argument("checkpoint", help="Prompt checkpoint written by save_soft_prompt, e.g. 1.pth")
+    parser.add_argument("--output", help="ONNX file to write (default: the checkpoint name with .onnx)")
+    parser.add_argument("--model-name", help="GPT-2 backbone (default: the one the prompt was trained on, else gpt2)")
+    parser.add_argument("--prompt", help="Space-separated prompt tokens from the checkpoint vocabulary (default: all, in order)")
+    parser.add_argument("--no-check", action="store_true", help="Skip the onnxruntime parity check")
+    args = parser.parse_args()
+
+    checkpoint = read_soft_prompt(args.checkpoint)
+    model_name = args.model_name or checkpoint["model_name"] or "gpt2"
+    model = load_soft_prompt(args.checkpoint, GPT2LMHeadModel.from_pretrained(model_name)).eval()
+    if args.prompt:
+        prompt_ids = torch.tensor([checkpoint["vocab"].index(word) for word in args.prompt.split()])
+    else:
+        prompt_ids = torch.arange(model.soft_prompt.num_embeddings)
+
+    output = args.output or os.path.splitext(args.checkpoint)[0] + ".onnx"
+    export_onnx(model, prompt_ids, output)
+    print(f"Wrote {output}")
+    if not args.no_check:
+        print(json.dumps(check_parity(model, prompt_ids, output), indent=2))
+
+
+if __name__ == "__main__":
+    main()
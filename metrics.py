@@ -0,0 +1,331 @@
+import collections
+import io
+import math
+import re
+import string
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+
+import numpy as np
+import torch
+
+from data_utils import get_tokenizer, init_tokenizer_worker
+
+
+# Token Overlap
+def token_overlap(predictions, labels, ignore_index=None):
+    # Per row, the percentage of distinct predicted ids that also occur in the label row, i.e.
+    # len(set(pred) & set(label)) / len(set(pred)) * 100, computed with sorts and masks on the
+    # device instead of Python sets. Shapes are static, so nothing waits for the device.
+    # With ignore_index, only the positions whose label is not ignore_index count on both sides.
+    if ignore_index is not None:
+        ignored = labels == ignore_index
+        predictions, labels = predictions.masked_fill(ignored, -1), labels.masked_fill(ignored, -1)
+    predictions = predictions.sort(dim=-1).values
+    labels = labels.sort(dim=-1).values
+    distinct = torch.ones_like(predictions, dtype=torch.bool)
+    distinct[:, 1:] = predictions[:, 1:] != predictions[:, :-1]
+    if ignore_index is not None:
+        distinct &= predictions != -1
+    position = torch.searchsorted(labels, predictions).clamp(max=labels.shape[-1] - 1)
+    found = labels.gather(-1, position) == predictions
+    return (distinct & found).sum(-1) / distinct.sum(-1).clamp(min=1) * 100
+
+
+class MetricAccumulator:
+    # Running sums of the token overlap and the loss, kept on the device. Nothing is read back
+    # until compute(), which the loops call once per epoch or every METRICS_LOG_INTERVAL steps.
+    def __init__(self, device):
+        self.sums = torch.zeros(2, dtype=torch.float64, device=device)
+        self.rows = 0
+
+    def update(self, predictions, labels, loss=None, ignore_index=None):
+        # predictions are the greedy ids [B, T]; loss is the batch mean, weighted by the number
+        # of rows like the old total_*_loss. ignore_index restricts the overlap to labelled positions.
+        with torch.no_grad():
+            self.sums[0] += token_overlap(predictions, labels, ignore_index).sum()
+            if loss is not None:
+                self.sums[1] += loss.detach() * len(labels)
+        self.rows += len(labels)
+
+    def compute(self):
+        overlap, loss = (self.sums / max(self.rows, 1)).tolist()
+        return {"overlap": overlap, "loss": loss}
+
+
+# Model Parity
+def state_dict_nbytes(module):
+    # Serialized size of a module's weights; counts packed int8 weights of quantized layers,
+    # which parameters() does not list, and tied weights once
+    buffer = io.BytesIO()
+    torch.save(module.state_dict(), buffer)
+    return buffer.getbuffer().nbytes
+
+
+def compare_models(reference, candidate, loader, prompt_ids, ignore_index=-100):
+    # Loss, token overlap and forward time of two GPT2WithSoftPrompt models (e.g. fp32 and
+    # int8) on the same batches, and how often their greedy predictions agree. Each model
+    # runs on the device of its soft prompt.
+    models = {"reference": reference, "candidate": candidate}
+    sums = {name: collections.Counter() for name in models}
+    agreement = 0.0
+    rows = 0
+    with torch.no_grad():
+        for input_ids, attention_mask, labels in loader:
+            predictions = []
+            for name, model in models.items():
+                device = model.soft_prompt.weight.device
+                start = time.perf_counter()
+                logits = model(input_ids.to(device), prompt_ids.to(device), attention_mask=attention_mask.to(device)).logits.cpu()
+                sums[name]["forward_seconds"] += time.perf_counter() - start
+                loss = torch.nn.functional.cross_entropy(logits.flatten(0, 1), labels.flatten(), ignore_index=ignore_index)
+                sums[name]["loss"] += loss.item() * len(labels)
+                sums[name]["token_overlap"] += token_overlap(logits.argmax(dim=-1), labels).sum().item()
+                predictions.append(logits.argmax(dim=-1))
+            agreement += (predictions[0] == predictions[1]).float().mean(dim=-1).sum().item()
+            rows += len(labels)
+
+    rows = max(rows, 1)
+    report = {}
+    for name, model in models.items():
+        report[name] = {
+            "loss": sums[name]["loss"] / rows,
+            "token_overlap": sums[name]["token_overlap"] / rows,
+            "forward_ms_per_row": 1000 * sums[name]["forward_seconds"] / rows,
+            "weights_mb": state_dict_nbytes(model) / 2 ** 20,
+        }
+    report["argmax_agreement"] = 100 * agreement / rows
+    report["loss_abs_diff"] = abs(report["reference"]["loss"] - report["candidate"]["loss"])
+    return report
+
+
+# BLEU
+def ngram_counter(words, order):
+    return collections.Counter(tuple(words[i:i + order]) for i in range(len(words) - order + 1))
+
+
+def ngram_keys(tokens, order, base):
+    # One int64 key per n-gram of a token id array, n-gram i spanning tokens[i:i + order]
+    keys = tokens[:len(tokens) - order + 1].astype(np.int64)
+    for offset in range(1, order):
+        keys = keys * base + tokens[offset:len(tokens) - order + 1 + offset]
+    return keys
+
+
+def clipped_matches(hypothesis, reference, order):
+    # Hypothesis n-grams also in the reference, each counted at most as often as it occurs there
+    if len(hypothesis) < order or len(reference) < order:
+        return 0
+    if isinstance(hypothesis, np.ndarray) and isinstance(reference, np.ndarray):
+        base = int(max(hypothesis.max(initial=0), reference.max(initial=0))) + 1
+        if base ** order < 2 ** 63:
+            hyp_keys, hyp_counts = np.unique(ngram_keys(hypothesis, order, base), return_counts=True)
+            ref_keys, ref_counts = np.unique(ngram_keys(reference, order, base), return_counts=True)
+            _, hyp_index, ref_index = np.intersect1d(hyp_keys, ref_keys, assume_unique=True, return_indices=True)
+            return int(np.minimum(hyp_counts[hyp_index], ref_counts[ref_index]).sum())
+    return sum((ngram_counter(hypothesis, order) & ngram_counter(reference, order)).values())
+
+
+class BleuAccumulator:
+    # Corpus BLEU (one reference per hypothesis, no smoothing, like nltk's corpus_bleu) from
+    # sufficient statistics: clipped n-gram matches, n-gram totals and the two corpus lengths.
+    # Memory is constant however many examples are added. add() takes token id arrays or any
+    # token sequences, add_text() whitespace-split text.
+    def __init__(self, max_order=4):
+        self.max_order = max_order
+        self.matches = np.zeros(max_order, dtype=np.int64)
+        self.totals = np.zeros(max_order, dtype=np.int64)
+        self.hypothesis_length = 0
+        self.reference_length = 0
+
+    def add(self, hypothesis, reference):
+        for order in range(1, self.max_order + 1):
+            self.matches[order - 1] += clipped_matches(hypothesis, reference, order)
+            self.totals[order - 1] += max(len(hypothesis) - order + 1, 0)
+        self.hypothesis_length += len(hypothesis)
+        self.reference_length += len(reference)
+
+    def add_text(self, hypothesis, reference):
+        self.add(hypothesis.split(), reference.split())
+
+    def merge(self, other):
+        self.matches += other.matches
+        self.totals += other.totals
+        self.hypothesis_length += other.hypothesis_length
+        self.reference_length += other.reference_length
+
+    def compute(self):
+        if self.hypothesis_length == 0 or not self.matches.all():
+            return 0.0
+        log_precision = np.mean(np.log(self.matches / self.totals))
+        brevity_penalty = min(1.0, math.exp(1 - self.reference_length / self.hypothesis_length))
+        return float(brevity_penalty * math.exp(log_precision))
+
+
+# ROUGE
+def f_measure(overlap, hypothesis_total, reference_total):
+    if overlap == 0:
+        return 0.0
+    precision = overlap / hypothesis_total
+    recall = overlap / reference_total
+    return 2 * precision * recall / (precision + recall)
+
+
+def lcs_length(a, b):
+    # Longest common subsequence, one row of the dynamic programming table at a time
+    previous = [0] * (len(b) + 1)
+    for x in a:
+        current = [0]
+        for j, y in enumerate(b):
+            current.append(previous[j] + 1 if x == y else max(previous[j + 1], current[j]))
+        previous = current
+    return previous[-1]
+
+
+class RougeAccumulator:
+    # Mean ROUGE-1/2/L F1 over examples, on lowercased whitespace-split words
+    def __init__(self):
+        self.sums = collections.Counter()
+        self.count = 0
+
+    def add_text(self, hypothesis, reference):
+        hypothesis, reference = hypothesis.lower().split(), reference.lower().split()
+        for order in (1, 2):
+            hyp_counts, ref_counts = ngram_counter(hypothesis, order), ngram_counter(reference, order)
+            overlap = sum((hyp_counts & ref_counts).values())
+            self.sums[f"rouge{order}"] += f_measure(overlap, sum(hyp_counts.values()), sum(ref_counts.values()))
+        self.sums["rougeL"] += f_measure(lcs_length(hypothesis, reference), len(hypothesis), len(reference))
+        self.count += 1
+
+    def merge(self, other):
+        self.sums.update(other.sums)
+        self.count += other.count
+
+    def compute(self):
+        return {name: self.sums[name] / max(self.count, 1) for name in ("rouge1", "rouge2", "rougeL")}
+
+
+# SQuAD
+def normalize_answer(text):
+    # The official SQuAD normalization: lowercase, no punctuation, articles or extra whitespace
+    text = "".join(character for character in text.lower() if character not in string.punctuation)
+    text = re.sub(r"\b(a|an|the)\b", " ", text)
+    return " ".join(text.split())
+
+
+class SquadAccumulator:
+    # Mean SQuAD exact match and token F1 (in percent) over answerable questions. Rows with an
+    # empty reference (unanswerable question) are only counted: with teacher forcing their
+    # prediction is always empty too, so scoring them would inflate both numbers.
+    def __init__(self):
+        self.exact_match = 0.0
+        self.f1 = 0.0
+        self.count = 0
+        self.no_answer = 0
+
+    def add_text(self, hypothesis, reference):
+        hypothesis, reference = normalize_answer(hypothesis).split(), normalize_answer(reference).split()
+        if not reference:
+            self.no_answer += 1
+            return
+        self.exact_match += float(hypothesis == reference)
+        if hypothesis:
+            overlap = sum((collections.Counter(hypothesis) & collections.Counter(reference)).values())
+            self.f1 += f_measure(overlap, len(hypothesis), len(reference))
+        self.count += 1
+
+    def merge(self, other):
+        self.exact_match += other.exact_match
+        self.f1 += other.f1
+        self.count += other.count
+        self.no_answer += other.no_answer
+
+    def compute(self):
+        count = max(self.count, 1)
+        return {"exact_match": 100 * self.exact_match / count, "f1": 100 * self.f1 / count, "no_answer_skipped": self.no_answer}
+
+
+# Metric Worker Pool
+TEXT_METRICS = {"bleu": BleuAccumulator, "rouge": RougeAccumulator, "squad": SquadAccumulator}
+
+
+def model_answer(predictions, ignore_ids):
+    # The model's own answer: its predictions up to the first ignored id it predicts (e.g. eos).
+    # Positions the loops did not project are filled with ignore_index, so they end it as well.
+    stop = np.flatnonzero(np.isin(predictions, ignore_ids))
+    return predictions[:stop[0]] if len(stop) else predictions
+
+
+def score_batch(metric, model_name, predictions, labels, ignore_ids, decode):
+    # Runs in a worker: scores each row's predicted answer against its real label tokens (not
+    # ignore_ids), decoding both sides to text unless decode is False (BLEU on token ids)
+    accumulator = TEXT_METRICS[metric]()
+    tokenizer = get_tokenizer(model_name) if decode else None
+    for hypothesis, reference in zip(predictions, labels):
+        hypothesis, reference = model_answer(hypothesis, ignore_ids), reference[~np.isin(reference, ignore_ids)]
+        if decode:
+            accumulator.add_text(tokenizer.decode(hypothesis, skip_special_tokens=True), tokenizer.decode(reference, skip_special_tokens=True))
+        else:
+            accumulator.add(hypothesis, reference)
+    return accumulator
+
+
+def to_host(tensor):
+    # Starts a copy of a device tensor into pinned host memory without waiting for it
+    if not tensor.is_cuda:
+        return tensor.detach()
+    host = torch.empty(tensor.shape, dtype=tensor.dtype, pin_memory=True)
+    host.copy_(tensor, non_blocking=True)
+    return host
+
+
+class MetricWorkerPool:
+    # Decodes and scores batches of predicted/label ids in background processes, so the model
+    # loop never waits on string processing. submit() only starts a non-blocking copy of the id
+    # tensors to pinned host memory; a batch is handed to the workers once its copy has finished,
+    # checked without waiting on later submits. compute() waits for the remaining copies, merges
+    # the per-batch results, typically at the end of an epoch, and starts over.
+    def __init__(self, metric, model_name, ignore_ids=(), num_workers=2, decode=True):
+        self.metric = metric
+        self.model_name = model_name
+        self.ignore_ids = np.array(sorted(ignore_ids), dtype=np.int64)
+        self.decode = decode
+        self.executor = ProcessPoolExecutor(num_workers, initializer=init_tokenizer_worker, initargs=(model_name,)) if num_workers > 0 else None
+        self.copying = collections.deque()
+        self.pending = []
+
+    def submit(self, predictions, labels):
+        host_predictions, host_labels = to_host(predictions), to_host(labels)
+        event = None
+        if predictions.is_cuda:
+            # Recorded after the copies were queued on the current stream, so it completes with them
+            event = torch.cuda.Event()
+            event.record()
+        self.copying.append((host_predictions, host_labels, event))
+        self.dispatch(wait=False)
+
+    def dispatch(self, wait):
+        # Hands the copied batches to the workers in order; without wait, stops at the first
+        # batch whose copy is still running
+        while self.copying:
+            predictions, labels, event = self.copying[0]
+            if event is not None:
+                if wait:
+                    event.synchronize()
+                elif not event.query():
+                    break
+            self.copying.popleft()
+            args = (self.metric, self.model_name, predictions.numpy(), labels.numpy(), self.ignore_ids, self.decode)
+            self.pending.append(self.executor.submit(score_batch, *args) if self.executor else score_batch(*args))
+
+    def compute(self):
+        self.dispatch(wait=True)
+        accumulator = TEXT_METRICS[self.metric]()
+        for result in self.pending:
+            accumulator.merge(result.result() if isinstance(result, Future) else result)
+        self.pending = []
+        return accumulator.compute()
+
+    def close(self):
+        if self.executor:
+            self.executor.shutdown()
@@ -0,0 +1,82 @@
+import types
+
+import numpy as np
+import onnxruntime
+
+
+class OnnxSoftPrompt:
+    # onnxruntime backend for a soft prompt exported by export_onnx.py, called like
+    # GPT2WithSoftPrompt but on numpy arrays, so serving needs neither torch nor transformers.
+    # The prompt is baked into the graph as per-layer keys/values; the graph takes input_ids,
+    # the attention mask of the past + new input tokens and their past keys/values, and returns
+    # the logits of the new tokens, their present keys/values and the prompt's own logits.
+    def __init__(self, path, providers=("CPUExecutionProvider",), num_threads=None):
+        options = onnxruntime.SessionOptions()
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        self.session = onnxruntime.InferenceSession(path, options, providers=list(providers))
+        inputs = {node.name: node.shape for node in self.session.get_inputs()}
+        outputs = {node.name: node.shape for node in self.session.get_outputs()}
+        self.num_layers, _, self.num_heads, _, self.head_dim = inputs["past_keys"]
+        self.num_prompts = outputs["prompt_logits"][0]
+
+    def run(self, input_ids, attention_mask, past_keys=None, past_values=None):
+        # One graph call; attention_mask covers the past tokens and input_ids, never the prompt
+        if past_keys is None:
+            past_keys = past_values = np.zeros((self.num_layers, len(input_ids), self.num_heads, 0, self.head_dim), dtype=np.float32)
+        feed = {
+            "input_ids": np.asarray(input_ids, dtype=np.int64),
+            "attention_mask": np.asarray(attention_mask, dtype=np.int64),
+            "past_keys": past_keys,
+            "past_values": past_values,
+        }
+        return self.session.run(["logits", "present_keys", "present_values", "prompt_logits"], feed)
+
+    def __call__(self, input_ids, prompt_ids=None, attention_mask=None, positions="all"):
+        # Same logits as GPT2WithSoftPrompt.forward: [B, P + T, V] for positions="all" or
+        # [B, 1, V] for "last". prompt_ids is accepted for compatibility, the graph has its prompt.
+        if positions not in ("all", "last"):
+            raise ValueError("the ONNX graph returns logits only, positions must be 'all' or 'last'")
+        input_ids = np.asarray(input_ids, dtype=np.int64)
+        unbatched = input_ids.ndim == 1
+        if unbatched:
+            input_ids = input_ids[None]
+        attention_mask = np.ones_like(input_ids) if attention_mask is None else np.asarray(attention_mask, dtype=np.int64).reshape(input_ids.shape)
+
+        logits, present_keys, present_values, prompt_logits = self.run(input_ids, attention_mask)
+        if positions == "last":
+            logits = logits[:, -1:]
+        else:
+            logits = np.concatenate([np.broadcast_to(prompt_logits, (len(logits),) + prompt_logits.shape), logits], axis=1)
+        return types.SimpleNamespace(logits=logits[0] if unbatched else logits, past_key_values=(present_keys, present_values))
+
+    def generate(self, input_ids, prompt_ids=None, attention_mask=None, max_new_tokens=50, eos_token_id=None):
+        # Greedy decoding with the past keys/values, the same tokens as
+        # GPT2WithSoftPrompt.generate(do_sample=False, num_beams=1)
+        input_ids = np.asarray(input_ids, dtype=np.int64)
+        unbatched = input_ids.ndim == 1
+        if unbatched:
+            input_ids = input_ids[None]
+        attention_mask = np.ones_like(input_ids) if attention_mask is None else np.asarray(attention_mask, dtype=np.int64).reshape(input_ids.shape)
+
+        # Left padding puts every row's last real token in the last column
+        order = np.argsort(attention_mask, axis=1, kind="stable")
+        input_ids = np.take_along_axis(input_ids, order, axis=1)
+        attention_mask = np.take_along_axis(attention_mask, order, axis=1)
+
+        pad_token_id = eos_token_id if eos_token_id is not None else 0
+        finished = np.zeros(len(input_ids), dtype=bool)
+        logits, past_keys, past_values, _ = self.run(input_ids, attention_mask)
+        tokens = []
+        for step in range(max_new_tokens):
+            next_tokens = np.where(finished, pad_token_id, logits[:, -1].argmax(axis=-1))
+            tokens.append(next_tokens)
+            if eos_token_id is not None:
+                finished |= next_tokens == eos_token_id
+            if finished.all() or step == max_new_tokens - 1:
+                break
+            attention_mask = np.concatenate([attention_mask, np.ones((len(attention_mask), 1), dtype=np.int64)], axis=1)
+            logits, past_keys, past_values, _ = self.run(next_tokens[:, None], attention_mask, past_keys, past_values)
+
+        generated = np.stack(tokens, axis=1)
+        return generated[0] if unbatched else generated
@@ -0,0 +1,663 @@
+import contextlib
+import copy
+import hashlib
+import json
+import os
+import time
+
+import torch
+import transformers
+from torch.utils.checkpoint import checkpoint
+from transformers import GPT2LMHeadModel
+from transformers.modeling_outputs import CausalLMOutputWithPast
+from transformers.pytorch_utils import Conv1D
+
+
+# Compute dtype of each precision option
+PRECISIONS = {"fp32": torch.float32, "bf16": torch.bfloat16}
+
+# Rows of hidden states projected through the LM head at once by the chunked loss and argmax,
+# and vocabulary columns per projection in the chunked argmax
+LM_HEAD_CHUNK_SIZE = 1024
+LM_HEAD_VOCAB_CHUNK_SIZE = 8192
+
+
+# Model Architecture
+class GPT2WithSoftPrompt(torch.nn.Module):
+    def __init__(self, model_name, num_prompts, embedding_size=768, freeze_backbone=None, gpt2=None, precision="fp32", gradient_checkpointing=None):
+        super().__init__()
+        # An already built GPT2LMHeadModel can be passed as gpt2 to skip from_pretrained. Other
+        # models may share it, so its requires_grad and checkpointing flags are only changed when
+        # freeze_backbone or gradient_checkpointing is given; a backbone loaded here is frozen.
+        if gpt2 is None:
+            gpt2 = GPT2LMHeadModel.from_pretrained(model_name)
+            freeze_backbone = True if freeze_backbone is None else freeze_backbone
+        self.gpt2 = gpt2
+        self.soft_prompt = torch.nn.Embedding(num_prompts, embedding_size)
+        if freeze_backbone is not None:
+            self.set_backbone_trainable(not freeze_backbone)
+        if gradient_checkpointing is not None:
+            self.set_gradient_checkpointing(gradient_checkpointing)
+        self.precision = precision
+        self.prefix_cache = None
+
+    def set_backbone_trainable(self, trainable):
+        # With a frozen backbone autograd keeps no GPT-2 weight gradients and only the
+        # activations needed to backpropagate into the soft prompt embeddings
+        for param in self.gpt2.parameters():
+            param.requires_grad_(trainable)
+
+    def set_gradient_checkpointing(self, enabled):
+        # In training, each GPT-2 block keeps only its input and is recomputed during backward,
+        # trading about one extra forward for most of the activation memory. The non-reentrant
+        # variant still backpropagates into the soft prompt when the backbone is frozen.
+        if enabled:
+            self.gpt2.gradient_checkpointing_enable(gradient_checkpointing_kwargs={"use_reentrant": False})
+        else:
+            self.gpt2.gradient_checkpointing_disable()
+
+    def autocast(self):
+        # precision="bf16" runs the GPT-2 matmuls under bfloat16 autocast; the weights, the soft
+        # prompt and its optimizer state stay fp32, and logits are returned as fp32
+        if self.precision not in PRECISIONS:
+            raise ValueError(f"precision must be one of {sorted(PRECISIONS)}, not {self.precision!r}")
+        if self.precision == "fp32":
+            return contextlib.nullcontext()
+        return torch.autocast(self.soft_prompt.weight.device.type, dtype=PRECISIONS[self.precision])
+
+    def run_gpt2(self, positions="all", **kwargs):
+        # Runs the GPT-2 transformer and projects the final hidden states of `positions` through
+        # the LM head: "all", "last" (the next token, all generation needs) or None (no logits).
+        # outputs.hidden_states holds the final-layer hidden states [B, T, H].
+        with self.autocast():
+            outputs = self.gpt2.transformer(**kwargs)
+            hidden_states = outputs.last_hidden_state
+            logits = None
+            if positions is not None:
+                logits = self.gpt2.lm_head(hidden_states[:, -1:] if positions == "last" else hidden_states).float()
+        return CausalLMOutputWithPast(logits=logits, past_key_values=outputs.past_key_values, hidden_states=hidden_states)
+
+    def hidden_states(self, input_ids, prompt_ids, attention_mask=None, prompt_mask=None):
+        # Final-layer hidden states [B, P + T, H] of prompt + input, without the LM head, for
+        # lm_loss() and lm_argmax(). Uses the prompt prefix cache like forward().
+        outputs, _, _ = self.prefill(input_ids, prompt_ids, attention_mask, prompt_mask, positions=None)
+        return outputs.hidden_states
+
+    def lm_loss(self, hidden_states, labels, ignore_index=-100, chunk_size=LM_HEAD_CHUNK_SIZE, reduction="mean"):
+        # Same value as CrossEntropyLoss(ignore_index, reduction)(logits.flatten(0, 1), labels.flatten())
+        # on the forward() logits, without ever building them
+        with self.autocast():
+            return chunked_cross_entropy(hidden_states, self.gpt2.lm_head.weight, labels, ignore_index, chunk_size, reduction)
+
+    def lm_argmax(self, hidden_states, positions=None, fill_value=-100, chunk_size=LM_HEAD_CHUNK_SIZE, vocab_chunk_size=LM_HEAD_VOCAB_CHUNK_SIZE):
+        # Greedy ids [B, P + T] (or [P + T] unbatched). positions, a boolean [B, P + T] mask of the
+        # positions of interest (e.g. labels != ignore_index), limits the LM head to those rows on
+        # the CPU (see gathers_positions); the others get fill_value. The head runs on chunk_size
+        # rows x vocab_chunk_size columns at a time.
+        with torch.no_grad(), self.autocast():
+            gather = positions is not None and gathers_positions(hidden_states)
+            hidden = hidden_states[positions] if gather else hidden_states.reshape(-1, hidden_states.size(-1))
+            ids = chunked_argmax(hidden, self.gpt2.lm_head.weight, chunk_size, vocab_chunk_size)
+        if positions is None:
+            return ids.view(hidden_states.shape[:-1])
+        if gather:
+            return ids.new_full(positions.shape, fill_value).masked_scatter(positions, ids)
+        return torch.where(positions, ids.view(positions.shape), fill_value)
+
+    def embed(self, input_ids, prompt_ids, attention_mask=None, prompt_mask=None):
+        # input_ids: [B, T], prompt_ids: [P] shared by every row or [B, P] per row.
+        # prompt_mask marks the padding of rows whose prompt is shorter than P.
+        batch_size = input_ids.size(0)
+        if prompt_ids.dim() == 1:
+            prompt_ids = prompt_ids.unsqueeze(0).expand(batch_size, -1)
+        if attention_mask is None:
+            attention_mask = torch.ones_like(input_ids)
+
+        prompt_embeddings = self.soft_prompt(prompt_ids)
+        base_embeddings = self.gpt2.transformer.wte(input_ids)
+        embeddings = torch.cat([prompt_embeddings, base_embeddings], dim=1)
+
+        # The soft prompt is always attended to, padding never is
+        if prompt_mask is None:
+            prompt_mask = attention_mask.new_ones(batch_size, prompt_ids.size(1))
+        attention_mask = torch.cat([prompt_mask.to(attention_mask.dtype), attention_mask], dim=1)
+
+        # Positions count real tokens only, so left or right padding does not shift them
+        position_ids = (attention_mask.long().cumsum(dim=-1) - 1).clamp(min=0)
+        return embeddings, attention_mask, position_ids
+
+    def forward(self, input_ids, prompt_ids, attention_mask=None, prompt_mask=None, positions="all"):
+        # A single unbatched [T] sequence keeps returning [P + T, V] logits. positions="last"
+        # returns logits for the last position only, positions=None hidden states only.
+        unbatched = input_ids.dim() == 1
+        if unbatched:
+            input_ids = input_ids.unsqueeze(0)
+            if attention_mask is not None:
+                attention_mask = attention_mask.unsqueeze(0)
+            if prompt_mask is not None:
+                prompt_mask = prompt_mask.unsqueeze(0)
+
+        outputs, _, _ = self.prefill(input_ids, prompt_ids, attention_mask, prompt_mask, positions=positions)
+
+        if unbatched:
+            outputs.hidden_states = outputs.hidden_states.squeeze(0)
+            if outputs.logits is not None:
+                outputs.logits = outputs.logits.squeeze(0)
+        return outputs
+
+    def prefill(self, input_ids, prompt_ids, attention_mask=None, prompt_mask=None, use_cache=False, positions="all"):
+        # Runs prompt + input through GPT-2 and returns the outputs with the full attention mask
+        # and position ids. When every row shares one prompt and no gradients are needed, the
+        # prompt's keys/values come from the prefix cache and only the input is computed.
+        if prompt_ids.dim() == 1 and prompt_mask is None and not self.training and not torch.is_grad_enabled():
+            return self.prefill_from_prefix(input_ids, prompt_ids, attention_mask, use_cache, positions)
+
+        embeddings, attention_mask, position_ids = self.embed(input_ids, prompt_ids, attention_mask, prompt_mask)
+        outputs = self.run_gpt2(positions, inputs_embeds=embeddings, attention_mask=attention_mask, position_ids=position_ids, use_cache=use_cache)
+        return outputs, attention_mask, position_ids
+
+    def prompt_prefix(self, prompt_ids):
+        # Per-layer keys/values, hidden states and logits of the prompt alone, computed once and reused. The
+        # key includes the embedding's version counter, which every in-place update (optimizer
+        # step, load_state_dict, copy_) bumps, so a changed prompt is recomputed automatically,
+        # and the precision, since bf16 keys/values differ from fp32 ones.
+        weight = self.soft_prompt.weight
+        key = (tuple(prompt_ids.tolist()), weight._version, weight.data_ptr(), weight.dtype, weight.device, id(self.gpt2), self.precision)
+        if self.prefix_cache is None or self.prefix_cache[0] != key:
+            outputs = self.run_gpt2(inputs_embeds=self.soft_prompt(prompt_ids).unsqueeze(0), use_cache=True)
+            self.prefix_cache = (key, cache_tensors(outputs.past_key_values), outputs.hidden_states, outputs.logits)
+        return self.prefix_cache[1:]
+
+    def clear_prompt_cache(self):
+        self.prefix_cache = None
+
+    def prefill_from_prefix(self, input_ids, prompt_ids, attention_mask=None, use_cache=False, positions="all"):
+        batch_size, num_prompts = input_ids.size(0), prompt_ids.size(0)
+        prefix, prompt_hidden_states, prompt_logits = self.prompt_prefix(prompt_ids)
+        past_key_values = to_cache(tuple((key.expand(batch_size, -1, -1, -1), value.expand(batch_size, -1, -1, -1)) for key, value in prefix))
+
+        if attention_mask is None:
+            attention_mask = torch.ones_like(input_ids)
+        attention_mask = torch.cat([attention_mask.new_ones(batch_size, num_prompts), attention_mask], dim=1)
+        position_ids = (attention_mask.long().cumsum(dim=-1) - 1).clamp(min=0)
+
+        outputs = self.run_gpt2(positions, input_ids=input_ids, past_key_values=past_key_values, attention_mask=attention_mask,
+                                position_ids=position_ids[:, num_prompts:], use_cache=use_cache)
+        outputs.hidden_states = torch.cat([prompt_hidden_states.expand(batch_size, -1, -1), outputs.hidden_states], dim=1)
+        if positions == "all":
+            outputs.logits = torch.cat([prompt_logits.expand(batch_size, -1, -1), outputs.logits], dim=1)
+        return outputs, attention_mask, position_ids
+
+    @torch.no_grad()
+    def generate(self, input_ids, prompt_ids, attention_mask=None, max_new_tokens=50, eos_token_id=None,
+                 do_sample=False, temperature=1.0, top_k=0, top_p=1.0, num_beams=1, length_penalty=1.0):
+        # Autoregressive decoding that feeds one new token per step through past_key_values.
+        # Returns only the new tokens, [B, N] (or [N] for an unbatched input); rows that hit
+        # eos_token_id early are padded with it.
+        unbatched = input_ids.dim() == 1
+        if unbatched:
+            input_ids = input_ids.unsqueeze(0)
+            if attention_mask is not None:
+                attention_mask = attention_mask.unsqueeze(0)
+        if attention_mask is None:
+            attention_mask = torch.ones_like(input_ids)
+
+        # Left padding puts every row's last real token in the last column
+        input_ids, attention_mask = left_pad(input_ids, attention_mask)
+        if num_beams > 1:
+            input_ids = input_ids.repeat_interleave(num_beams, dim=0)
+            attention_mask = attention_mask.repeat_interleave(num_beams, dim=0)
+            if prompt_ids.dim() == 2:
+                prompt_ids = prompt_ids.repeat_interleave(num_beams, dim=0)
+
+        outputs, attention_mask, position_ids = self.prefill(input_ids, prompt_ids, attention_mask, use_cache=True, positions="last")
+        state = (outputs, attention_mask, position_ids[:, -1:])
+
+        if num_beams > 1:
+            generated = self.beam_search(state, num_beams, max_new_tokens, eos_token_id, length_penalty)
+        else:
+            generated = self.sample(state, max_new_tokens, eos_token_id, do_sample, temperature, top_k, top_p)
+        return generated.squeeze(0) if unbatched else generated
+
+    def decode_step(self, next_tokens, past_key_values, attention_mask, position_ids):
+        attention_mask = torch.cat([attention_mask, attention_mask.new_ones(attention_mask.size(0), 1)], dim=1)
+        position_ids = position_ids + 1
+        outputs = self.run_gpt2(input_ids=next_tokens.unsqueeze(1), past_key_values=past_key_values,
+                                attention_mask=attention_mask, position_ids=position_ids, use_cache=True)
+        return outputs, attention_mask, position_ids
+
+    def sample(self, state, max_new_tokens, eos_token_id, do_sample, temperature, top_k, top_p):
+        outputs, attention_mask, position_ids = state
+        pad_token_id = eos_token_id if eos_token_id is not None else 0
+        finished = torch.zeros(attention_mask.size(0), dtype=torch.bool, device=attention_mask.device)
+        tokens = []
+
+        for step in range(max_new_tokens):
+            logits = outputs.logits[:, -1].float()
+            if do_sample:
+                logits = filter_logits(logits / temperature, top_k, top_p)
+                next_tokens = torch.multinomial(logits.softmax(dim=-1), num_samples=1).squeeze(1)
+            else:
+                next_tokens = logits.argmax(dim=-1)
+            next_tokens = next_tokens.masked_fill(finished, pad_token_id)
+            tokens.append(next_tokens)
+
+            if eos_token_id is not None:
+                finished |= next_tokens == eos_token_id
+            if finished.all() or step == max_new_tokens - 1:
+                break
+            outputs, attention_mask, position_ids = self.decode_step(next_tokens, outputs.past_key_values, attention_mask, position_ids)
+
+        return torch.stack(tokens, dim=1)
+
+    def beam_search(self, state, num_beams, max_new_tokens, eos_token_id, length_penalty):
+        outputs, attention_mask, position_ids = state
+        pad_token_id = eos_token_id if eos_token_id is not None else 0
+        device = attention_mask.device
+        num_rows = attention_mask.size(0)
+        batch_size = num_rows // num_beams
+
+        # Start from a single live beam per example so the first step does not pick duplicates
+        beam_scores = torch.zeros((batch_size, num_beams), device=device)
+        beam_scores[:, 1:] = float("-inf")
+        beam_scores = beam_scores.flatten()
+        finished = torch.zeros(num_rows, dtype=torch.bool, device=device)
+        lengths = torch.zeros(num_rows, dtype=torch.long, device=device)
+        sequences = torch.empty((num_rows, 0), dtype=torch.long, device=device)
+        beam_offsets = torch.arange(batch_size, device=device).unsqueeze(1) * num_beams
+
+        for step in range(max_new_tokens):
+            log_probs = outputs.logits[:, -1].float().log_softmax(dim=-1)
+            vocab_size = log_probs.size(-1)
+            # A finished beam can only be extended by padding, at no cost
+            log_probs[finished] = float("-inf")
+            log_probs[finished, pad_token_id] = 0.0
+
+            candidates = (beam_scores.unsqueeze(1) + log_probs).view(batch_size, num_beams * vocab_size)
+            top_scores, top_indices = candidates.topk(num_beams, dim=1)
+            source = (beam_offsets + top_indices // vocab_size).flatten()
+            next_tokens = (top_indices % vocab_size).flatten()
+
+            beam_scores = top_scores.flatten()
+            sequences = torch.cat([sequences[source], next_tokens.unsqueeze(1)], dim=1)
+            lengths = lengths[source] + (~finished[source]).long()
+            finished = finished[source]
+            if eos_token_id is not None:
+                finished |= next_tokens == eos_token_id
+            if finished.all() or step == max_new_tokens - 1:
+                break
+
+            past_key_values = reorder_cache(outputs.past_key_values, source)
+            outputs, attention_mask, position_ids = self.decode_step(next_tokens, past_key_values, attention_mask[source], position_ids[source])
+
+        normalized = beam_scores / lengths.clamp(min=1).float() ** length_penalty
+        best = beam_offsets.squeeze(1) + normalized.view(batch_size, num_beams).argmax(dim=1)
+        return sequences[best]
+
+
+# Generation Helpers
+def left_pad(input_ids, attention_mask):
+    # Stable sort on the mask moves padding to the front and keeps the token order
+    order = torch.argsort(attention_mask, dim=1, stable=True)
+    return input_ids.gather(1, order), attention_mask.gather(1, order)
+
+
+def filter_logits(logits, top_k=0, top_p=1.0):
+    if top_k > 0:
+        kth_best = logits.topk(min(top_k, logits.size(-1)), dim=-1).values[..., -1:]
+        logits = logits.masked_fill(logits < kth_best, float("-inf"))
+    if top_p < 1.0:
+        sorted_logits, sorted_indices = logits.sort(dim=-1, descending=True)
+        probs = sorted_logits.softmax(dim=-1)
+        # Drop a token once the tokens ranked above it already cover top_p
+        remove = probs.cumsum(dim=-1) - probs > top_p
+        sorted_logits = sorted_logits.masked_fill(remove, float("-inf"))
+        logits = logits.scatter(-1, sorted_indices, sorted_logits)
+    return logits
+
+
+def cache_tensors(past_key_values):
+    # Per-layer (key, value) tensors of a past_key_values, whatever transformers version made it
+    if isinstance(past_key_values, tuple):
+        return past_key_values
+    if hasattr(past_key_values, "to_legacy_cache"):
+        return past_key_values.to_legacy_cache()
+    return tuple((layer.keys, layer.values) for layer in past_key_values.layers)
+
+
+def to_cache(layers):
+    # Fresh past_key_values for the model; DynamicCache is extended in place, so never share one
+    try:
+        from transformers import DynamicCache
+    except ImportError:
+        return layers
+    if hasattr(DynamicCache, "from_legacy_cache"):
+        return DynamicCache.from_legacy_cache(layers)
+    return DynamicCache(layers)
+
+
+def reorder_cache(past_key_values, index):
+    if hasattr(past_key_values, "reorder_cache"):
+        past_key_values.reorder_cache(index)
+        return past_key_values
+    return tuple(tuple(tensor.index_select(0, index) for tensor in layer) for layer in past_key_values)
+
+# Chunked LM Head Loss
+def gathers_positions(tensor):
+    # Gathering the labelled positions with a boolean mask gives a data-dependent shape, which
+    # makes the host wait for an accelerator on every step. On the CPU nothing waits, so only
+    # there are those positions gathered; elsewhere every position goes through the LM head in
+    # fixed-size chunks and the unlabelled ones are masked out.
+    return tensor.device.type == "cpu"
+
+
+def chunk_cross_entropy(hidden, weight, targets, ignore_index):
+    return torch.nn.functional.cross_entropy(torch.nn.functional.linear(hidden, weight).float(), targets, ignore_index=ignore_index, reduction="sum")
+
+
+def chunked_cross_entropy(hidden_states, weight, labels, ignore_index=-100, chunk_size=LM_HEAD_CHUNK_SIZE, reduction="mean"):
+    # Mean (or with reduction="sum", summed) cross-entropy of the tied LM head over the positions
+    # whose label is not ignore_index. Positions are projected chunk_size rows at a time, only the
+    # labelled ones on the CPU (see gathers_positions), and each chunk's logits are recomputed in
+    # backward instead of saved, so peak memory is chunk_size x V, not T x V. The label count
+    # stays a device tensor, so the mean needs no read-back either.
+    hidden, targets = hidden_states.reshape(-1, hidden_states.size(-1)), labels.reshape(-1)
+    keep = targets != ignore_index
+    if gathers_positions(hidden):
+        hidden, targets = hidden[keep], targets[keep]
+    # Starts from an (empty) sum of the hidden rows so a batch without labels still has a graph
+    total = hidden[:0].sum().float()
+    for start in range(0, len(targets), chunk_size):
+        end = start + chunk_size
+        total = total + checkpoint(chunk_cross_entropy, hidden[start:end], weight, targets[start:end], ignore_index, use_reentrant=False)
+    return total if reduction == "sum" else total / keep.sum()
+
+
+def chunked_argmax(hidden, weight, chunk_size=LM_HEAD_CHUNK_SIZE, vocab_chunk_size=LM_HEAD_VOCAB_CHUNK_SIZE):
+    # argmax of hidden @ weight.T per row, keeping a running maximum over vocabulary chunks so
+    # at most chunk_size x vocab_chunk_size logits exist at once. Ties go to the lowest id, as
+    # with argmax.
+    ids = []
+    for start in range(0, len(hidden), chunk_size):
+        rows = hidden[start:start + chunk_size]
+        best_values, best_ids = None, None
+        for vocab_start in range(0, weight.size(0), vocab_chunk_size):
+            values, index = torch.nn.functional.linear(rows, weight[vocab_start:vocab_start + vocab_chunk_size]).float().max(dim=-1)
+            index = index + vocab_start
+            if best_values is None:
+                best_values, best_ids = values, index
+            else:
+                better = values > best_values
+                best_values, best_ids = torch.where(better, values, best_values), torch.where(better, index, best_ids)
+        ids.append(best_ids)
+    return torch.cat(ids) if ids else torch.zeros(0, dtype=torch.long, device=hidden.device)
+
+
+# Quantized Backbone
+def conv1d_to_linear(conv):
+    # GPT-2's Conv1D computes x @ weight + bias with weight [in, out], i.e. a transposed Linear
+    linear = torch.nn.Linear(conv.weight.size(0), conv.weight.size(1))
+    with torch.no_grad():
+        linear.weight.copy_(conv.weight.t())
+        linear.bias.copy_(conv.bias)
+    return linear
+
+
+def quantize_backbone(gpt2):
+    # Inference-only CPU copy of gpt2 whose transformer block projections (attention and MLP
+    # Conv1D/Linear layers) are dynamic int8: int8 weights, activations quantized per batch.
+    # Embeddings, layer norms and the lm_head tied to the token embeddings stay fp32, as does
+    # the soft prompt a GPT2WithSoftPrompt puts in front of it. The original is not modified.
+    gpt2 = copy.deepcopy(gpt2).cpu().float().eval()
+    for module in list(gpt2.transformer.h.modules()):
+        for name, child in list(module.named_children()):
+            if isinstance(child, Conv1D):
+                setattr(module, name, conv1d_to_linear(child))
+    gpt2.transformer.h = torch.ao.quantization.quantize_dynamic(gpt2.transformer.h, {torch.nn.Linear}, dtype=torch.qint8)
+    return gpt2
+
+
+# Compiled Inference
+# Total (prompt + input) lengths the inference graphs are specialized for; an input is
+# right-padded up to the smallest bucket that holds it
+INFERENCE_BUCKETS = (128, 256, 512, 1024)
+
+
+class PromptGraph(torch.nn.Module):
+    # What gets exported: one fixed prompt + input ids and mask -> final hidden states. It always
+    # takes the embedding path, since the prefix cache is Python state a graph cannot hold.
+    def __init__(self, model, prompt_ids):
+        super().__init__()
+        self.model = model
+        self.register_buffer("prompt_ids", prompt_ids)
+
+    def forward(self, input_ids, attention_mask):
+        embeddings, attention_mask, position_ids = self.model.embed(input_ids, self.prompt_ids, attention_mask)
+        return self.model.run_gpt2(None, inputs_embeds=embeddings, attention_mask=attention_mask, position_ids=position_ids).hidden_states
+
+
+def set_inductor_cache_dir(cache_dir):
+    # inductor reads its kernel cache location from the environment for the whole process, so
+    # this is set once per process (not per CompiledSoftPrompt), before anything is compiled
+    os.environ["TORCHINDUCTOR_CACHE_DIR"] = os.path.abspath(os.path.join(cache_dir, "inductor"))
+
+
+class CompiledSoftPrompt:
+    # Inference-only stand-in for a GPT2WithSoftPrompt with one prompt, called like it. Every
+    # (batch size, bucket) shape gets a torch.export graph that is saved in cache_dir and reloaded
+    # by later processes, and with compile=True is compiled by torch.compile, whose kernels go to
+    # inductor's process-wide cache (see set_inductor_cache_dir). The graphs use the model's own
+    # weights, so a retrained prompt needs no new export. Generation stays on model.generate().
+    def __init__(self, model, prompt_ids, cache_dir="compiled_cache", buckets=INFERENCE_BUCKETS, compile=True, pad_token_id=0):
+        self.model = model.eval()
+        self.prompt_ids = prompt_ids
+        self.graph_module = PromptGraph(model, prompt_ids)
+        self.cache_dir = cache_dir
+        self.buckets = sorted(bucket for bucket in buckets if len(prompt_ids) < bucket <= model.gpt2.config.n_positions)
+        self.compile = compile
+        self.pad_token_id = pad_token_id
+        self.graphs = {}
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def bucket(self, length):
+        total = len(self.prompt_ids) + length
+        for bucket in self.buckets:
+            if total <= bucket:
+                return bucket
+        raise ValueError(f"prompt + input length {total} does not fit the largest inference bucket {self.buckets[-1]}")
+
+    def graph_path(self, batch_size, bucket):
+        # Keyed by everything the traced code depends on: parameter names, shapes and dtypes,
+        # the precision, the input shape and the torch and transformers versions (the traced code is
+        # transformers' GPT-2 forward). Weight values are not part of it.
+        structure = [(name, str(tensor.dtype), list(tensor.shape)) for name, tensor in self.graph_module.state_dict().items()]
+        identity = [backbone_fingerprint(self.model.gpt2), structure, self.model.precision, batch_size, bucket, torch.__version__, transformers.__version__]
+        digest = hashlib.sha256(json.dumps(identity).encode("utf-8")).hexdigest()[:16]
+        return os.path.join(self.cache_dir, f"graph-{batch_size}x{bucket}-{digest}.pt2")
+
+    def graph(self, batch_size, bucket):
+        if (batch_size, bucket) not in self.graphs:
+            path = self.graph_path(batch_size, bucket)
+            if not os.path.exists(path):
+                input_ids = torch.full((batch_size, bucket - len(self.prompt_ids)), self.pad_token_id, device=self.prompt_ids.device)
+                with torch.no_grad():
+                    program = torch.export.export(self.graph_module, (input_ids, torch.ones_like(input_ids)), strict=False)
+                tmp_path = f"{path[:-len('.pt2')]}.tmp-{os.getpid()}.pt2"
+                torch.export.save(program, tmp_path)
+                os.replace(tmp_path, path)
+            graph = torch.export.load(path).module()
+            # Point the loaded graph at the live weights instead of its saved copy of them
+            state = self.graph_module.state_dict()
+            graph.load_state_dict({name: state[name] for name in graph.state_dict()}, assign=True)
+            self.graphs[batch_size, bucket] = torch.compile(graph, dynamic=False) if self.compile else graph
+        return self.graphs[batch_size, bucket]
+
+    def warmup(self, batch_sizes=(1,), buckets=None):
+        # Builds (or loads from cache_dir) and runs the graph of every batch size and bucket once,
+        # so requests never wait for an export or compilation. Returns the seconds each took.
+        timings = {}
+        for batch_size in batch_sizes:
+            for bucket in buckets or self.buckets:
+                input_ids = torch.full((batch_size, bucket - len(self.prompt_ids)), self.pad_token_id, device=self.prompt_ids.device)
+                start = time.perf_counter()
+                self.hidden_states(input_ids)
+                timings[f"{batch_size}x{bucket}"] = time.perf_counter() - start
+        return timings
+
+    def hidden_states(self, input_ids, prompt_ids=None, attention_mask=None):
+        if prompt_ids is not None and not torch.equal(prompt_ids.cpu(), self.prompt_ids.cpu()):
+            raise ValueError("this CompiledSoftPrompt was built for a different prompt")
+        if attention_mask is None:
+            attention_mask = torch.ones_like(input_ids)
+        batch_size, length = input_ids.shape
+        bucket = self.bucket(length)
+        # Right padding is masked out and comes after every real token, so it changes nothing
+        padding = bucket - len(self.prompt_ids) - length
+        input_ids = torch.nn.functional.pad(input_ids, (0, padding), value=self.pad_token_id)
+        attention_mask = torch.nn.functional.pad(attention_mask, (0, padding), value=0)
+        with torch.no_grad():
+            hidden_states = self.graph(batch_size, bucket)(input_ids, attention_mask)
+        return hidden_states[:, :len(self.prompt_ids) + length]
+
+    def __call__(self, input_ids, prompt_ids=None, attention_mask=None, positions="all"):
+        # Same outputs as GPT2WithSoftPrompt.forward: logits for "all" or the "last" position,
+        # or only outputs.hidden_states with positions=None
+        unbatched = input_ids.dim() == 1
+        if unbatched:
+            input_ids = input_ids.unsqueeze(0)
+            if attention_mask is not None:
+                attention_mask = attention_mask.unsqueeze(0)
+        hidden_states = self.hidden_states(input_ids, prompt_ids, attention_mask)
+        logits = None
+        if positions is not None:
+            with torch.no_grad(), self.model.autocast():
+                logits = self.model.gpt2.lm_head(hidden_states[:, -1:] if positions == "last" else hidden_states).float()
+        if unbatched:
+            hidden_states = hidden_states.squeeze(0)
+            logits = logits.squeeze(0) if logits is not None else None
+        return CausalLMOutputWithPast(logits=logits, hidden_states=hidden_states)
+
+    def lm_argmax(self, hidden_states, **kwargs):
+        return self.model.lm_argmax(hidden_states, **kwargs)
+
+
+# Prompt Checkpoints
+PROMPT_CHECKPOINT_VERSION = 1
+
+
+def backbone_fingerprint(gpt2):
+    # Identifies the backbone a prompt was trained against without hashing 500MB of weights
+    config = gpt2.config
+    identity = [config.name_or_path, config.vocab_size, config.n_positions, config.n_embd, config.n_layer, config.n_head]
+    return hashlib.sha256(json.dumps(identity).encode("utf-8")).hexdigest()[:16]
+
+
+def save_soft_prompt(model, path, vocab, max_len):
+    # Only the prompt embeddings and what is needed to use them, a few KB instead of 500MB
+    torch.save({
+        "version": PROMPT_CHECKPOINT_VERSION,
+        "soft_prompt": model.soft_prompt.weight.detach().cpu().clone(),
+        "vocab": list(vocab),
+        "model_name": model.gpt2.config.name_or_path,
+        "backbone": backbone_fingerprint(model.gpt2),
+        "max_len": max_len,
+    }, path)
+
+
+def read_soft_prompt(path):
+    checkpoint = torch.load(path, map_location="cpu")
+    if "version" not in checkpoint:
+        # Full GPT2WithSoftPrompt state_dict written by older versions of the scripts
+        checkpoint = {
+            "version": 0,
+            "soft_prompt": checkpoint["soft_prompt.weight"],
+            "vocab": None,
+            "model_name": None,
+            "backbone": None,
+            "max_len": None,
+        }
+    return checkpoint
+
+
+def check_backbone(checkpoint, gpt2, path):
+    fingerprint = backbone_fingerprint(gpt2)
+    if checkpoint["backbone"] is not None and checkpoint["backbone"] != fingerprint:
+        raise ValueError(
+            f"{path} was trained on backbone {checkpoint['model_name']!r} ({checkpoint['backbone']}), "
+            f"not {gpt2.config.name_or_path!r} ({fingerprint})"
+        )
+
+
+def load_soft_prompt(path, gpt2, precision="fp32"):
+    # Attaches a saved prompt to an already loaded GPT2LMHeadModel, no from_pretrained call
+    checkpoint = read_soft_prompt(path)
+    check_backbone(checkpoint, gpt2, path)
+
+    weight = checkpoint["soft_prompt"]
+    model = GPT2WithSoftPrompt(checkpoint["model_name"], weight.size(0), embedding_size=weight.size(1), gpt2=gpt2, precision=precision)
+    with torch.no_grad():
+        model.soft_prompt.weight.copy_(weight)
+    model.soft_prompt.to(next(gpt2.parameters()).device)
+    model.prompt_vocab = checkpoint["vocab"]
+    model.max_len = checkpoint["max_len"]
+    return model
+
+
+# Multi-task Serving
+class PromptRegistry:
+    # Many named soft prompts in front of one resident GPT-2. All prompts are stacked into a
+    # single embedding table, so a batch can mix tasks: every row gathers its own prompt,
+    # shorter prompts are left padded and masked out.
+    def __init__(self, gpt2, precision="fp32"):
+        self.gpt2 = gpt2
+        self.precision = precision
+        self.prompts = {}
+        self.spans = {}
+        self.model = None
+
+    def register(self, name, weight):
+        self.prompts[name] = weight.detach().cpu()
+        self.model = None
+
+    def load(self, name, path):
+        checkpoint = read_soft_prompt(path)
+        check_backbone(checkpoint, self.gpt2, path)
+        self.register(name, checkpoint["soft_prompt"])
+
+    def build(self):
+        table = torch.cat(list(self.prompts.values()), dim=0)
+        self.spans = {}
+        start = 0
+        for name, weight in self.prompts.items():
+            self.spans[name] = (start, weight.size(0))
+            start += weight.size(0)
+
+        model = GPT2WithSoftPrompt(None, table.size(0), embedding_size=table.size(1), gpt2=self.gpt2, precision=self.precision)
+        with torch.no_grad():
+            model.soft_prompt.weight.copy_(table)
+        # Only the wrapper is switched to eval mode; the shared backbone keeps its own mode
+        self.model = model.to(next(self.gpt2.parameters()).device)
+        self.model.training = False
+        self.model.soft_prompt.eval()
+        return self.model
+
+    def prompt_ids(self, tasks):
+        # tasks: one registered name per row
+        max_len = max(self.spans[task][1] for task in tasks)
+        prompt_ids = torch.zeros((len(tasks), max_len), dtype=torch.long)
+        prompt_mask = torch.zeros((len(tasks), max_len), dtype=torch.long)
+        for row, task in enumerate(tasks):
+            start, length = self.spans[task]
+            prompt_ids[row, max_len - length:] = torch.arange(start, start + length)
+            prompt_mask[row, max_len - length:] = 1
+        return prompt_ids, prompt_mask
+
+    def __call__(self, input_ids, tasks, attention_mask=None):
+        model = self.model if self.model is not None else self.build()
+        if isinstance(tasks, str):
+            tasks = [tasks] * (input_ids.size(0) if input_ids.dim() == 2 else 1)
+        prompt_ids, prompt_mask = self.prompt_ids(tasks)
+        device = input_ids.device
+        if input_ids.dim() == 1:
+            prompt_ids, prompt_mask = prompt_ids[0], prompt_mask[0]
+        return model(input_ids, prompt_ids.to(device), attention_mask=attention_mask, prompt_mask=prompt_mask.to(device))
@@ -0,0 +1,140 @@
+import json
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from data_utils import ParallelCorpus, build_line_offsets, iter_json_array, line_offsets
+
+
+class TempDirTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+    def write(self, name, text):
+        path = os.path.join(self.tmp.name, name)
+        with open(path, "w", encoding="utf-8", newline="") as file:
+            file.write(text)
+        return path
+
+
+class IterJsonArrayTest(TempDirTestCase):
+    def test_every_chunk_size(self):
+        # Every split of the key, the separators and the elements across chunk boundaries,
+        # including numbers, which are only complete once the next character is read
+        data = [{"title": "a", "paragraphs": [{"context": "c", "qas": []}]}, 12345, "s,]", [], {"data": 1}]
+        text = json.dumps({"version": "v2.0", "data": data}, indent=1)
+        path = self.write("data.json", text)
+        for chunk_size in range(1, len(text) + 1):
+            self.assertEqual(list(iter_json_array(path, "data", chunk_size=chunk_size)), data, chunk_size)
+
+    def test_key_split_across_chunks(self):
+        path = self.write("data.json", '{"version": "v", "data" : [1, 2]}')
+        # '"data"' starts at byte 17, a chunk size of 20 cuts it in two
+        self.assertEqual(list(iter_json_array(path, "data", chunk_size=20)), [1, 2])
+
+    def test_element_larger_than_chunk(self):
+        element = {"context": "x" * 1000, "qas": [{"question": "q" * 500}]}
+        path = self.write("data.json", json.dumps({"data": [element, element]}))
+        self.assertEqual(list(iter_json_array(path, "data", chunk_size=16)), [element, element])
+
+    def test_empty_array(self):
+        path = self.write("data.json", '{"data": [], "version": "v2.0"}')
+        for chunk_size in (1, 4, 1 << 20):
+            self.assertEqual(list(iter_json_array(path, "data", chunk_size=chunk_size)), [])
+
+    def test_truncated_input(self):
+        for text in ('{"data": [{"a": 1}, {"b"', '{"data": [{"a": 1}', '{"data": [1, 2', '{"data"', '{"data": ['):
+            path = self.write("data.json", text)
+            for chunk_size in (1, 3, 1 << 20):
+                with self.assertRaises(ValueError, msg=(text, chunk_size)):
+                    list(iter_json_array(path, "data", chunk_size=chunk_size))
+
+    def test_missing_key(self):
+        path = self.write("data.json", '{"version": "v2.0"}')
+        with self.assertRaises(ValueError):
+            list(iter_json_array(path, "data", chunk_size=4))
+
+
+class LineOffsetsTest(TempDirTestCase):
+    def check(self, text):
+        path = self.write("corpus.txt", text)
+        with open(path, "rb") as file:
+            lines = file.readlines()
+        expected = np.cumsum([0] + [len(line) for line in lines])
+        for block_size in (1, 2, 3, 7, 1 << 24):
+            np.testing.assert_array_equal(build_line_offsets(path, block_size=block_size), expected)
+
+    def test_trailing_newline(self):
+        self.check("one\ntwo\n\nfour\n")
+
+    def test_no_trailing_newline(self):
+        self.check("one\ntwo\n\nfour")
+
+    def test_multibyte_and_empty(self):
+        self.check("Grüße\nünd\n")
+        self.check("")
+        self.check("\n")
+
+    def test_cached_index_is_rebuilt_when_the_file_changes(self):
+        cache_dir = os.path.join(self.tmp.name, "cache")
+        path = self.write("corpus.txt", "a\nb\n")
+        np.testing.assert_array_equal(line_offsets(path, cache_dir), [0, 2, 4])
+        np.testing.assert_array_equal(line_offsets(path, cache_dir), [0, 2, 4])
+        self.write("corpus.txt", "a\nbb\nccc")
+        np.testing.assert_array_equal(line_offsets(path, cache_dir), [0, 2, 5, 8])
+
+
+class ParallelCorpusTest(TempDirTestCase):
+    def corpus(self, trailing_newline, cache_dir=None):
+        source = "".join(f"source {index} ä\n" for index in range(10))
+        target = "".join(f"target {index}\n" for index in range(10))
+        if not trailing_newline:
+            source, target = source[:-1], target[:-1]
+        paths = self.write("corpus.en", source), self.write("corpus.de", target)
+        expected = []
+        for path in paths:
+            with open(path, encoding="utf-8", newline="") as file:
+                expected.append(file.readlines())
+        return ParallelCorpus(*paths, cache_dir=cache_dir), expected
+
+    def check(self, trailing_newline, cache_dir=None):
+        corpus, (source, target) = self.corpus(trailing_newline, cache_dir)
+        self.assertEqual(len(corpus), 10)
+        self.assertEqual(corpus.read(), (source, target))
+        self.assertEqual(corpus.read(3, 7), (source[3:7], target[3:7]))
+        self.assertEqual(corpus.read(8, 100), (source[8:], target[8:]))
+        self.assertEqual(corpus.read(5, 2), ([], []))
+
+        shards = [corpus.shard(index, 3) for index in range(3)]
+        self.assertEqual(sum(len(shard) for shard in shards), 10)
+        self.assertEqual([line for shard in shards for line in shard.read()[0]], source)
+        self.assertEqual(shards[2].read()[1], target[len(target) - len(shards[2]):])
+
+        sampled_source, sampled_target = corpus.sample(4, seed=1)
+        self.assertEqual(len(sampled_source), 4)
+        self.assertEqual([source.index(line) for line in sampled_source], [target.index(line) for line in sampled_target])
+        self.assertEqual(corpus.sample(4, seed=1), (sampled_source, sampled_target))
+        self.assertEqual(sorted(corpus.sample(100)[0]), sorted(source))
+
+    def test_trailing_newline(self):
+        self.check(True)
+
+    def test_no_trailing_newline(self):
+        self.check(False)
+
+    def test_cached_offsets(self):
+        cache_dir = os.path.join(self.tmp.name, "cache")
+        self.check(True, cache_dir)
+        self.check(False, cache_dir)
+
+    def test_line_count_mismatch(self):
+        paths = self.write("corpus.en", "a\nb\n"), self.write("corpus.de", "a\n")
+        with self.assertRaises(ValueError):
+            ParallelCorpus(*paths)
+
+
+if __name__ == "__main__":
+    unittest.main()
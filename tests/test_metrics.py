@@ -0,0 +1,85 @@
+import unittest
+import warnings
+
+import numpy as np
+from nltk.translate.bleu_score import corpus_bleu
+
+from metrics import BleuAccumulator, clipped_matches
+
+
+def random_corpus(seed, num_pairs=50, vocab_size=20):
+    # Small vocabulary and lengths so every n-gram order has matches, plus a few exact copies
+    rng = np.random.default_rng(seed)
+    references = [rng.integers(0, vocab_size, rng.integers(4, 30)) for _ in range(num_pairs)]
+    hypotheses = [rng.integers(0, vocab_size, rng.integers(4, 30)) for _ in range(num_pairs)]
+    hypotheses[:5] = [reference.copy() for reference in references[:5]]
+    return hypotheses, references
+
+
+def nltk_bleu(hypotheses, references):
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        return corpus_bleu([[list(reference)] for reference in references], [list(hypothesis) for hypothesis in hypotheses])
+
+
+class BleuAccumulatorTest(unittest.TestCase):
+    def test_matches_nltk_corpus_bleu(self):
+        for seed in range(5):
+            hypotheses, references = random_corpus(seed)
+            on_arrays, on_lists = BleuAccumulator(), BleuAccumulator()
+            for hypothesis, reference in zip(hypotheses, references):
+                on_arrays.add(hypothesis, reference)
+                on_lists.add(hypothesis.tolist(), reference.tolist())
+            expected = nltk_bleu(hypotheses, references)
+            self.assertAlmostEqual(on_arrays.compute(), expected, places=12)
+            self.assertAlmostEqual(on_lists.compute(), expected, places=12)
+
+    def test_matches_nltk_on_words(self):
+        hypotheses = ["the cat sat on the mat today", "a quick brown fox jumps over the dog", "hello there general kenobi"]
+        references = ["the cat sat on a mat", "the quick brown fox jumps over the lazy dog", "hello there general kenobi"]
+        accumulator = BleuAccumulator()
+        for hypothesis, reference in zip(hypotheses, references):
+            accumulator.add_text(hypothesis, reference)
+        expected = nltk_bleu([text.split() for text in hypotheses], [text.split() for text in references])
+        self.assertAlmostEqual(accumulator.compute(), expected, places=12)
+
+    def test_no_match_of_some_order_is_zero(self):
+        # nltk returns about 1e-231 here (it logs the smallest float instead of 0)
+        accumulator = BleuAccumulator()
+        accumulator.add(np.array([1, 2, 3, 4]), np.array([4, 3, 2, 1]))
+        self.assertEqual(accumulator.compute(), 0.0)
+        self.assertAlmostEqual(nltk_bleu([[1, 2, 3, 4]], [[4, 3, 2, 1]]), 0.0, places=12)
+        self.assertEqual(BleuAccumulator().compute(), 0.0)
+
+    def test_merge_equals_one_accumulator(self):
+        hypotheses, references = random_corpus(7)
+        whole, first, second = BleuAccumulator(), BleuAccumulator(), BleuAccumulator()
+        for index, (hypothesis, reference) in enumerate(zip(hypotheses, references)):
+            whole.add(hypothesis, reference)
+            (first if index % 2 else second).add(hypothesis, reference)
+        first.merge(second)
+        self.assertAlmostEqual(first.compute(), whole.compute(), places=12)
+
+
+class ClippedMatchesTest(unittest.TestCase):
+    def test_unique_key_path_equals_counter_path(self):
+        # np.unique over integer n-gram keys (arrays) against Counter of tuples (lists), on the
+        # same ids, including GPT-2 sized ids and lengths shorter than the order
+        rng = np.random.default_rng(0)
+        for vocab_size in (3, 50257):
+            for _ in range(200):
+                hypothesis = rng.integers(0, vocab_size, rng.integers(0, 40))
+                reference = rng.integers(0, vocab_size, rng.integers(0, 40))
+                for order in range(1, 5):
+                    self.assertEqual(clipped_matches(hypothesis, reference, order), clipped_matches(hypothesis.tolist(), reference.tolist(), order))
+
+    def test_keys_too_large_for_int64_fall_back_to_counter(self):
+        # base ** 4 would overflow int64 with ids this large
+        hypothesis = np.array([2 ** 20, 5, 2 ** 20, 5, 2 ** 20, 5])
+        reference = np.array([5, 2 ** 20, 5, 2 ** 20, 5])
+        for order in range(1, 5):
+            self.assertEqual(clipped_matches(hypothesis, reference, order), clipped_matches(hypothesis.tolist(), reference.tolist(), order))
+
+
+if __name__ == "__main__":
+    unittest.main()